@@ -0,0 +1,239 @@
+import os
+import pickle
+import tempfile
+from typing import List, Dict, Tuple, Iterable, Iterator, Any
+
+from database import Page, PAGE_SIZE, CACHE_SIZE
+from external_merge_sort import external_sort, RUN_SIZE
+
+AGGREGATES = ('count', 'sum', 'min', 'max', 'avg')
+# Number of partitions the spilled groups are hashed into
+NUM_PARTITIONS = 8
+# After this many levels of re-partitioning a partition is finished with the sort-based aggregation
+MAX_DEPTH = 3
+# Estimated size of a decoded row in memory, used to turn a memory budget in pages into a number of rows
+ROW_SIZE = 256
+# A group in the hash table takes about this many times its pickled size in memory (measured with tracemalloc for
+# int and short string keys, between 5 and 9 times), the memory use of the table is estimated with it
+GROUP_MEMORY_FACTOR = 8
+
+
+def new_states(aggs: List[Tuple[str, int]]) -> List[list]:
+    """
+    Every partial aggregate is stored as [number of values, value], where value is the running sum, min or max.
+    """
+    return [[0, None] for _ in aggs]
+
+
+def update_states(states: List[list], aggs: List[Tuple[str, int]], row: tuple):
+    for state, (func, column) in zip(states, aggs):
+        value = row[column]
+        if value is None:
+            continue
+        state[0] += 1
+        if func in ('sum', 'avg'):
+            state[1] = value if state[1] is None else state[1] + value
+        elif func == 'min':
+            state[1] = value if state[1] is None or value < state[1] else state[1]
+        elif func == 'max':
+            state[1] = value if state[1] is None or value > state[1] else state[1]
+
+
+def merge_states(states: List[list], aggs: List[Tuple[str, int]], other: List[list]):
+    """
+    Combine two partial aggregates of the same group, used for spilled groups and results of parallel workers.
+    """
+    for state, other_state, (func, _) in zip(states, other, aggs):
+        state[0] += other_state[0]
+        if other_state[1] is None:
+            continue
+        if state[1] is None:
+            state[1] = other_state[1]
+        elif func in ('sum', 'avg'):
+            state[1] += other_state[1]
+        elif func == 'min':
+            state[1] = min(state[1], other_state[1])
+        elif func == 'max':
+            state[1] = max(state[1], other_state[1])
+
+
+def finalize_states(states: List[list], aggs: List[Tuple[str, int]]) -> tuple:
+    result = []
+    for (count, value), (func, _) in zip(states, aggs):
+        if func == 'count':
+            result.append(count)
+        elif func == 'avg':
+            result.append(value / count if count else None)
+        else:
+            result.append(value)
+    return tuple(result)
+
+
+def check_aggregates(aggs: Dict[str, Tuple[str, int]]) -> List[Tuple[str, int]]:
+    """
+    :param aggs: Output name -> (aggregate function, column index)
+    :return: List of (aggregate function, column index) in the order of the output columns
+    """
+    for name, (func, _) in aggs.items():
+        if func not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate {func} for {name}")
+    return list(aggs.values())
+
+
+class PartitionFile:
+    """
+    Temporary file of spilled (group, partial aggregates) entries, stored in the same page format as the heap file.
+    Only the page that is currently being filled is kept in memory. Entries that don't fit in an empty page are
+    pickled to a separate overflow file.
+    """
+
+    def __init__(self, tmp_dir: str):
+        self.tmp_dir = tmp_dir
+        fd, self.file_path = tempfile.mkstemp(dir=tmp_dir, suffix='.part')
+        self.file = os.fdopen(fd, 'w+b')
+        self.overflow_path = None
+        self.overflow = None
+        self.page = Page()
+        self.size = 0
+
+    def write(self, entry: Tuple[tuple, List[list]]):
+        record = bytearray(pickle.dumps(entry))
+        self.size += len(record)
+        if self.page.insert_record(record) is not None:
+            return
+        self.flush()
+        self.page = Page()
+        if self.page.insert_record(record) is None:
+            if self.overflow is None:
+                fd, self.overflow_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.overflow')
+                self.overflow = os.fdopen(fd, 'w+b')
+            self.overflow.write(record)
+
+    def flush(self):
+        if self.page.page_footer.slot_count():
+            self.file.write(self.page.data)
+
+    def __iter__(self) -> Iterator[Tuple[tuple, List[list]]]:
+        self.flush()
+        self.page = Page()
+        self.file.seek(0)
+        while data := self.file.read(PAGE_SIZE):
+            for _, record in Page(bytearray(data)).iter_records():
+                yield pickle.loads(record)
+        if self.overflow is not None:
+            self.overflow.seek(0)
+            while True:
+                try:
+                    yield pickle.load(self.overflow)
+                except EOFError:
+                    break
+
+    def close(self):
+        self.file.close()
+        os.remove(self.file_path)
+        if self.overflow is not None:
+            self.overflow.close()
+            os.remove(self.overflow_path)
+
+
+def hash_aggregate(rows: Iterable[tuple], group_by: List[int], aggs: Dict[str, Tuple[str, int]],
+                   memory_pages: int = CACHE_SIZE) -> Iterator[tuple]:
+    """
+    Hash aggregation, rows are streamed through a hash table of partial aggregates. When the table grows over the
+    memory budget, the groups are spilled to hash partitions on disk and every partition is finished afterwards.
+
+    :param rows: Decoded records
+    :param group_by: Column indices to group on
+    :param aggs: Output name -> (aggregate function, column index), aggregate function is one of AGGREGATES
+    :param memory_pages: Memory budget of the hash table in pages, the memory of a group is estimated as
+                         GROUP_MEMORY_FACTOR times its pickled size, so the budget is approximate
+    :return: Generator of tuples (*group values, *aggregate values)
+    """
+    agg_list = check_aggregates(aggs)
+    entries = ((tuple(row[column] for column in group_by), row) for row in rows)
+    with tempfile.TemporaryDirectory(prefix='aggregate_') as tmp_dir:
+        for key, states in _hash_aggregate(entries, agg_list, memory_pages * PAGE_SIZE, tmp_dir, 0, False):
+            yield key + finalize_states(states, agg_list)
+
+
+def _hash_aggregate(entries: Iterable[Tuple[tuple, Any]], aggs: List[Tuple[str, int]], budget: int, tmp_dir: str,
+                    depth: int, partial: bool) -> Iterator[Tuple[tuple, List[list]]]:
+    """
+    :param entries: (group, row) or (group, partial aggregates) if `partial`
+    :param depth: Level of re-partitioning, used to pick a different hash function every level
+    :return: Generator of (group, partial aggregates)
+    """
+    table: Dict[tuple, List[list]] = {}
+    partitions: List[PartitionFile] = []
+    used = 0
+
+    for key, value in entries:
+        states = table.get(key)
+        if states is None:
+            states = table[key] = new_states(aggs)
+            # Approximate the memory used by a group with its size on disk
+            used += GROUP_MEMORY_FACTOR * len(pickle.dumps((key, states)))
+        if partial:
+            merge_states(states, aggs, value)
+        else:
+            update_states(states, aggs, value)
+
+        if used > budget:
+            if not partitions:
+                partitions = [PartitionFile(tmp_dir) for _ in range(NUM_PARTITIONS)]
+            _spill(table, partitions, depth)
+            table, used = {}, 0
+
+    if not partitions:
+        yield from table.items()
+        return
+
+    # Groups can be spread over the partitions and the table, so spill the remainder as well
+    _spill(table, partitions, depth)
+    del table
+    for partition in partitions:
+        if partition.size * GROUP_MEMORY_FACTOR <= budget or depth + 1 < MAX_DEPTH:
+            yield from _hash_aggregate(partition, aggs, budget, tmp_dir, depth + 1, True)
+        else:
+            yield from _sort_aggregate(partition, aggs, True)
+        partition.close()
+
+
+def _spill(table: Dict[tuple, List[list]], partitions: List[PartitionFile], depth: int):
+    for entry in table.items():
+        partitions[hash((depth, entry[0])) % len(partitions)].write(entry)
+
+
+def sort_aggregate(rows: Iterable[tuple], group_by: List[int], aggs: Dict[str, Tuple[str, int]],
+                   memory_pages: int = CACHE_SIZE) -> Iterator[tuple]:
+    """
+    Sort-based aggregation, rows are sorted on the group columns with the external merge sort, so every group
+    arrives as a consecutive sequence of rows and only one group is kept in memory.
+
+    :param rows: Decoded records
+    :param group_by: Column indices to group on
+    :param aggs: Output name -> (aggregate function, column index), aggregate function is one of AGGREGATES
+    :param memory_pages: Memory budget of the runs sorted in memory in pages
+    :return: Generator of tuples (*group values, *aggregate values), ordered on the group columns
+    """
+    agg_list = check_aggregates(aggs)
+    entries = ((tuple(row[column] for column in group_by), row) for row in rows)
+    run_size = max(1, memory_pages * PAGE_SIZE // ROW_SIZE)
+    for key, states in _sort_aggregate(entries, agg_list, False, run_size):
+        yield key + finalize_states(states, agg_list)
+
+
+def _sort_aggregate(entries: Iterable[Tuple[tuple, Any]], aggs: List[Tuple[str, int]], partial: bool,
+                    run_size: int = RUN_SIZE) -> Iterator[Tuple[tuple, List[list]]]:
+    current_key, states = None, None
+    for key, value in external_sort(entries, key=lambda entry: entry[0], run_size=run_size):
+        if states is None or key != current_key:
+            if states is not None:
+                yield current_key, states
+            current_key, states = key, new_states(aggs)
+        if partial:
+            merge_states(states, aggs, value)
+        else:
+            update_states(states, aggs, value)
+    if states is not None:
+        yield current_key, states
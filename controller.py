@@ -1,14 +1,18 @@
 import time
-from typing import List
+from typing import List, Dict, Tuple, Callable, Iterator
 
 import utils
-from database import HeapFile
-from external_merge_sort import two_way_external_merge_sort
+from database import HeapFile, CACHE_SIZE
 
 
 class Controller:
-    def __init__(self, filepath):
-        self.heap_file = HeapFile(filepath)
+    def __init__(self, filepath, schema: List[str] = None, layout: str = None):
+        """
+        :param filepath: Heap file
+        :param schema: Schema of the table, tables without var_str are stored in fixed-length pages
+        :param layout: Page layout, 'pax' to store the table column-grouped within every page, see HeapFile
+        """
+        self.heap_file = HeapFile(filepath, schema, layout)
 
     def insert(self, data, schema: List[str]):
         self.heap_file.insert_record(utils.encode_record(data, schema))
@@ -21,22 +25,75 @@ class Controller:
         return self.heap_file.read_record(byte_id)
 
     def delete(self, id_: int):
-        (page, slot_id) = self.heap_file.find_record(utils.encode_record([id_], ['int']))
-        if page is None:
-            print('Record not found!')
-            return
-        page.delete_record(slot_id)
+        self.heap_file.delete_record(utils.encode_record([id_], ['int']))
+
+    def vacuum(self, max_steps: int = None, relocate: bool = False) -> bool:
+        return self.heap_file.vacuum(max_steps, relocate)
+
+    def scan(self, schema: List[str]):
+        for record in self.heap_file.scan():
+            yield utils.decode_record(record, schema)
+
+    def scan_columns(self, schema: List[str], columns: List[int]):
+        return self.heap_file.scan_columns(schema, columns)
+
+    def aggregate(self, schema: List[str], group_by: List[int], aggs: Dict[str, Tuple[str, int]],
+                  memory_pages: int = CACHE_SIZE, method: str = 'hash') -> List[tuple]:
+        """
+        GROUP BY over the whole heap file, e.g. count users per country:
+        aggregate(schema, group_by=[8], aggs={'users': ('count', 0)})
+
+        :param schema: Schema of the records
+        :param group_by: Column indices to group on
+        :param aggs: Output name -> (aggregate function, column index), functions are count, sum, min, max and avg
+        :param memory_pages: Memory budget in pages, groups are spilled to disk when it is exceeded
+        :param method: 'hash' for hash aggregation, 'sort' for sort-based aggregation with the external merge sort
+        :return: List of tuples (*group values, *aggregate values)
+        """
+        # Imported here, so short-lived CRUD invocations don't pay for the analytics modules
+        from aggregation import hash_aggregate, sort_aggregate
+
+        # Only read the columns that are used, on PAX pages the other columns aren't touched
+        columns = sorted(set(group_by) | {column for _, column in aggs.values()})
+        rows = self.scan_columns(schema, columns)
+        group_by = [columns.index(column) for column in group_by]
+        aggs = {name: (func, columns.index(column)) for name, (func, column) in aggs.items()}
+        if method == 'hash':
+            return list(hash_aggregate(rows, group_by, aggs, memory_pages))
+        elif method == 'sort':
+            return list(sort_aggregate(rows, group_by, aggs, memory_pages))
+        raise ValueError(f"Unknown aggregation method {method}")
+
+    def parallel_scan(self, schema: List[str], predicate: Callable[[tuple], bool] = None, projection: List[int] = None,
+                      processes: int = None) -> Iterator[tuple]:
+        """
+        Filter and projection over the committed heap file, spread over `processes` worker processes.
+        The matching records are streamed, in the order they are stored.
+        """
+        from parallel_scan import parallel_scan
+        return parallel_scan(self.heap_file.file_path, schema, predicate, projection, processes)
+
+    def parallel_aggregate(self, schema: List[str], group_by: List[int], aggs: Dict[str, Tuple[str, int]],
+                           predicate: Callable[[tuple], bool] = None, processes: int = None) -> List[tuple]:
+        """
+        Same as `aggregate`, but over the committed heap file with partial aggregates computed by worker processes.
+        """
+        from parallel_scan import parallel_aggregate
+        return parallel_aggregate(self.heap_file.file_path, schema, group_by, aggs, predicate, processes)
 
     def commit(self):
         self.heap_file.close()
 
-    def sort(self):
-        pages = []
-        i = 1
-        while page := self.heap_file.find_page(i):
-            pages.append(page)
-            i += 1
-        two_way_external_merge_sort(pages, 0)
+    def sort(self, key: int = 0, prefetch: int = None) -> Iterator[bytearray]:
+        """
+        Sort the records with the 2-way external merge sort on the byte at index `key` of the encoded records.
+
+        :param prefetch: Number of runs read ahead and written behind during the merge, see external_merge_sort
+        :return: Generator of the sorted records
+        """
+        from external_merge_sort import two_way_external_merge_sort, PREFETCH
+        # Pages are read one at a time without caching them, phase 0 only keeps the page it is sorting in memory
+        return two_way_external_merge_sort(self.heap_file.iter_pages(), key, PREFETCH if prefetch is None else prefetch)
 
 
 if __name__ == '__main__':
@@ -48,7 +105,7 @@ if __name__ == '__main__':
     #     file.close()
     start = time.time()
     orm = Controller('database.bin')
-    orm.sort()
+    sorted_records = list(orm.sort())
 
     # if os.path.exists('users.csv'):
     #     df = pd.read_csv('users.csv')
@@ -1,8 +1,10 @@
+import bisect
+import itertools
 import os
+import struct
 import time
 from collections import deque
 from typing import Optional, List, Tuple
-import pandas as pd
 
 import utils
 
@@ -22,6 +24,42 @@ PAGE_NUM_SIZE = 3
 FREE_SPACE_SIZE = 3
 CACHE_SIZE = 10
 
+# Page layouts of a heap file
+SLOTTED = 'slotted'
+FIXED = 'fixed'
+PAX = 'pax'
+# Upper bit of the free space of a data page in a directory, the page is free and can be reused
+FREE_PAGE_FLAG = 0x800000
+# Pages with at least this fraction of free space are emptied by the vacuum
+VACUUM_SPARSE_FRACTION = 0.5
+# Phases of the vacuum, see HeapFile.vacuum
+VACUUM_COLLAPSE = 'collapse'
+VACUUM_DRAIN = 'drain'
+VACUUM_TRIM = 'trim'
+
+# Forward pointers, upper bits of the length in a slot
+FORWARD_FLAG = 0x8000  # Slot contains the RID the record moved to
+MOVED_FLAG = 0x4000  # Record moved away from its original slot, the original RID is stored in front of the record
+LENGTH_MASK = 0x3FFF
+SLOT_ID_SIZE = 2
+# RID -> (page number, slot id)
+RID_SIZE = PAGE_NUM_SIZE + SLOT_ID_SIZE
+
+# Page types, stored in the upper bits of the number of slots in the footer
+FIXED_PAGE_FLAG = 0x8000
+PAX_PAGE_FLAG = 0x4000
+
+# PAX pages
+PAX_TYPES = ('int', 'short', 'byte', 'var_str')  # Type codes in the page header
+PAX_FORMATS = {'int': 'I', 'short': 'H', 'byte': 'B'}  # struct formats of the fixed-width columns
+MINIPAGE_OFFSET_SIZE = 2
+VAR_OFFSET_SIZE = 2
+# State of a row in a PAX page
+ROW_DELETED = 0
+ROW_LIVE = 1
+ROW_FORWARD = 2
+ROW_MOVED = 3
+
 
 class PageFooter:
     def __init__(self, data: bytearray = None):
@@ -33,10 +71,13 @@ class PageFooter:
 
         # Contains pairs (offset to beginning of record, length of record), if length == 0, then record is deleted
         self.slot_dir = []
+        # Flags stored in the upper bits of the length of every slot (FORWARD_FLAG, MOVED_FLAG)
+        self.slot_flags = []
         for i in range(slot_count):
             slot = data[-FOOTER_SIZE - (i + 1) * SLOT_ENTRY_SIZE:-FOOTER_SIZE - i * SLOT_ENTRY_SIZE]
-            offset, length = slot[:OFFSET_SIZE], slot[LENGTH_SIZE:]
-            self.slot_dir.append((int.from_bytes(offset, 'little'), int.from_bytes(length, 'little')))
+            offset, length = slot[:OFFSET_SIZE], int.from_bytes(slot[LENGTH_SIZE:], 'little')
+            self.slot_dir.append((int.from_bytes(offset, 'little'), length & LENGTH_MASK))
+            self.slot_flags.append(length & ~LENGTH_MASK)
 
     def slot_count(self):
         return len(self.slot_dir)
@@ -47,6 +88,14 @@ class PageFooter:
                 FREE_SPACE_POINTER_SIZE, byteorder='little'))
 
 
+def encode_rid(rid: Tuple[int, int]) -> bytearray:
+    return bytearray(rid[0].to_bytes(PAGE_NUM_SIZE, 'little') + rid[1].to_bytes(SLOT_ID_SIZE, 'little'))
+
+
+def decode_rid(data: bytearray) -> Tuple[int, int]:
+    return int.from_bytes(data[:PAGE_NUM_SIZE], 'little'), int.from_bytes(data[PAGE_NUM_SIZE:RID_SIZE], 'little')
+
+
 class Page:
     def __init__(self, data=None):
         self.data = bytearray(PAGE_SIZE) if data is None else data
@@ -75,22 +124,50 @@ class Page:
         """
         return (PAGE_SIZE - FREE_SPACE_POINTER_SIZE * 2) - (SLOT_ENTRY_SIZE * (slot_id + 1))
 
-    def insert_record(self, record: bytearray):
+    def write_slot(self, slot_id, offset, length, flags=None):
+        """
+        Write (offset, length) of a slot to the slot dir. and the page footer, flags are kept if None.
+        """
+        if flags is None:
+            flags = self.page_footer.slot_flags[slot_id] if slot_id < self.page_footer.slot_count() else 0
+        if slot_id == self.page_footer.slot_count():
+            self.page_footer.slot_dir.append((offset, length))
+            self.page_footer.slot_flags.append(flags)
+        else:
+            self.page_footer.slot_dir[slot_id] = (offset, length)
+            self.page_footer.slot_flags[slot_id] = flags
+
+        new_slot_offset = Page.calculate_slot_offset(slot_id)
+        self.data[new_slot_offset: new_slot_offset + OFFSET_SIZE] = offset.to_bytes(OFFSET_SIZE, 'little')
+        self.data[new_slot_offset + OFFSET_SIZE: new_slot_offset + SLOT_ENTRY_SIZE] = (length | flags).to_bytes(
+            LENGTH_SIZE, 'little')
+
+    def insert_record(self, record: bytearray, slot_id=None, home: Tuple[int, int] = None) -> Optional[int]:
         """
         If there is not enough free space -> try to compact data, and use this free space, otherwise record can't be stored
         First check if there is a slot with 0 as length, to overwrite this
-        :param record:
-        :return:
+
+        :param record: Record to insert
+        :param slot_id: Reuse this (deleted) slot, used when a record grows and is rewritten on the same page
+        :param home: Original RID of a record that was moved away from its page, stored in front of the record
+        :return: Slot id of the inserted record, None if there was not enough space
         """
-        needed_space = len(record) + SLOT_ENTRY_SIZE
+        flags = 0
+        if home is not None:
+            record = encode_rid(home) + record
+            flags = MOVED_FLAG
+
+        needed_space = len(record) + (SLOT_ENTRY_SIZE if slot_id is None else 0)
         if needed_space > self.free_space():
-            return False
+            return None
 
         # Write data
         self.data[self.page_footer.free_space_pointer:self.page_footer.free_space_pointer + len(record)] = record
 
         # Check if page is packed, meaning no deleted records
-        if self.is_packed():
+        if slot_id is not None:
+            index = slot_id
+        elif self.is_packed():
             index = self.page_footer.slot_count()
         else:
             index = 0
@@ -98,43 +175,83 @@ class Page:
                 if length == 0:
                     index = i
 
-        # Update slots
-        new_slot_offset = Page.calculate_slot_offset(index)
-
-        # (offset, length)
-        self.data[new_slot_offset: new_slot_offset + OFFSET_SIZE] = self.page_footer.free_space_pointer.to_bytes(
-            OFFSET_SIZE, 'little')
-        self.data[new_slot_offset + OFFSET_SIZE: new_slot_offset + SLOT_ENTRY_SIZE] = len(record).to_bytes(LENGTH_SIZE,
-                                                                                                           'little')
-
-        # Update page footer
-        if self.is_packed():
-            self.page_footer.slot_dir.append((self.page_footer.free_space_pointer, len(record)))
-        else:
-            self.page_footer.slot_dir[index] = (self.page_footer.free_space_pointer, len(record))
+        # Update slots (offset, length) and page footer
+        self.write_slot(index, self.page_footer.free_space_pointer, len(record), flags)
 
         # Update free space pointer
         self.page_footer.free_space_pointer += len(record)
         self.update_header()
 
-        return True
+        return index
 
     def delete_record(self, slot_id):
         offset, length = self.page_footer.slot_dir[slot_id]
-        self.page_footer.slot_dir[slot_id] = (offset, 0)
-        new_slot_offset = Page.calculate_slot_offset(slot_id)
-        number = 0
-        self.data[new_slot_offset + OFFSET_SIZE:new_slot_offset + SLOT_ENTRY_SIZE] = number.to_bytes(LENGTH_SIZE,
-                                                                                                     'little')
+        self.write_slot(slot_id, offset, 0, 0)
         # Fix fragmentation
         self.compact_page()
 
     def read_record(self, slot_id):
+        """
+        Read a record, the RID in front of a moved record is skipped.
+        Forward pointers contain no record, see `forward_rid`.
+        """
         offset, length = self.page_footer.slot_dir[slot_id]
+        if self.page_footer.slot_flags[slot_id] & MOVED_FLAG:
+            return self.data[offset + RID_SIZE: offset + length]
         return self.data[offset: offset + length]
 
+    def has_record(self, slot_id) -> bool:
+        """
+        :return: True if the slot holds a record or a forward pointer
+        """
+        return slot_id < self.page_footer.slot_count() and self.page_footer.slot_dir[slot_id][1] > 0
+
+    def forward_rid(self, slot_id) -> Optional[Tuple[int, int]]:
+        """
+        :return: RID the record moved to if the slot is a forward pointer, else None
+        """
+        if self.page_footer.slot_flags[slot_id] & FORWARD_FLAG:
+            offset, _ = self.page_footer.slot_dir[slot_id]
+            return decode_rid(self.data[offset: offset + RID_SIZE])
+        return None
+
+    def home_rid(self, slot_id) -> Optional[Tuple[int, int]]:
+        """
+        :return: Original RID of a record that moved to this page, else None
+        """
+        if self.page_footer.slot_flags[slot_id] & MOVED_FLAG:
+            offset, _ = self.page_footer.slot_dir[slot_id]
+            return decode_rid(self.data[offset: offset + RID_SIZE])
+        return None
+
+    def forwards(self):
+        """
+        :return: Generator of (slot_id, RID) for every forward pointer on the page
+        """
+        for slot_id in range(self.page_footer.slot_count()):
+            if rid := self.forward_rid(slot_id):
+                yield slot_id, rid
+
+    def set_forward(self, slot_id, rid: Tuple[int, int]):
+        """
+        Replace the record in a slot by a forward pointer to the RID the record moved to.
+        """
+        self.write_slot(slot_id, self.page_footer.slot_dir[slot_id][0], 0, 0)
+        self.compact_page()
+        if self.insert_record(encode_rid(rid), slot_id) is None:
+            raise ValueError(f"Not enough space for a forward pointer in slot {slot_id}")
+        self.write_slot(slot_id, *self.page_footer.slot_dir[slot_id], FORWARD_FLAG)
+
     def update_record(self, slot_id, new_record):
+        """
+        Update a record in place, the slot id never changes.
+
+        :return: True if the record was updated, False if the page doesn't have enough space for the new record
+        """
         offset, length = self.page_footer.slot_dir[slot_id]
+        # Moved records keep their original RID in front of the record
+        if home := self.home_rid(slot_id):
+            new_record = encode_rid(home) + new_record
         # If new record size is equal, just overwrite
         if len(new_record) == length:
             self.data[offset:offset + length] = new_record
@@ -142,26 +259,53 @@ class Page:
         # If new record is smaller, we need to compact the page to avoid fragmentation
         elif len(new_record) < length:
             self.data[offset:offset + len(new_record)] = new_record
-            new_slot_offset = Page.calculate_slot_offset(slot_id)
-            self.page_footer.slot_dir[slot_id] = (offset, len(new_record))
-            self.data[new_slot_offset + OFFSET_SIZE:new_slot_offset + SLOT_ENTRY_SIZE] = len(new_record).to_bytes(
-                LENGTH_SIZE, 'little')
+            self.write_slot(slot_id, offset, len(new_record))
             self.compact_page()
             return True
-        # New record is lager, we can just insert the record
-        else:
-            # Delete record, length will be set to -1
+        # New record is larger, if it fits after deleting the old one rewrite it in the same slot
+        elif len(new_record) - length <= self.free_space():
+            flags = self.page_footer.slot_flags[slot_id]
             self.delete_record(slot_id)
-            # If returns True, enough free space on the page and slot_id stays the same, else we need to find a new page
-            return self.insert_record(new_record)
+            self.insert_record(new_record, slot_id)
+            self.write_slot(slot_id, *self.page_footer.slot_dir[slot_id], flags)
+            return True
+        # Not enough space on the page, the caller has to move the record
+        return False
+
+    def fits(self, slot_id, record: bytearray) -> bool:
+        """
+        Check if the record in this slot (or forward pointer) can be replaced by the record.
+        """
+        return len(record) - self.page_footer.slot_dir[slot_id][1] <= self.free_space()
+
+    def can_forward(self, slot_id) -> bool:
+        """
+        Check if the record in this slot can be replaced by a forward pointer.
+        """
+        return self.fits(slot_id, encode_rid((0, 0)))
 
     def find_record(self, byte_id: bytearray) -> int:
         for slot_id, (offset, length) in enumerate(self.page_footer.slot_dir):
+            flags = self.page_footer.slot_flags[slot_id]
+            # Skip deleted records and forward pointers, the record is found on the page it moved to
+            if length == 0 or flags & FORWARD_FLAG:
+                continue
+            if flags & MOVED_FLAG:
+                offset += RID_SIZE
             # some record, we assume the first field is the id and an int
-            record = self.data[offset: offset + length]
-            if byte_id == record[:4]:
+            if byte_id == self.data[offset: offset + 4]:
                 return slot_id
 
+    def iter_records(self):
+        """
+        Iterate over the live records of the page, deleted slots (length 0) and forward pointers are skipped.
+
+        :return: Generator of (slot_id, record)
+        """
+        for slot_id, (offset, length) in enumerate(self.page_footer.slot_dir):
+            if length != 0 and not self.page_footer.slot_flags[slot_id] & FORWARD_FLAG:
+                yield slot_id, self.read_record(slot_id)
+
     def is_full(self):
         return self.free_space() <= 0
 
@@ -176,9 +320,7 @@ class Page:
         :param index: tuple index for comparison
         :return:
         """
-        records = []
-        for slot_id in range(self.page_footer.slot_count()):
-            records.append(self.read_record(slot_id))
+        records = [record for _, record in self.iter_records()]
 
         return sorted(records, key=lambda x: (x[index], x[0]))
 
@@ -191,17 +333,16 @@ class Page:
         """
         write_ptr = 0
 
-        for i, (offset, length) in enumerate(self.page_footer.slot_dir):
+        # Records are moved in the order they are stored, a rewritten record can be stored after records of later slots
+        slot_dir = self.page_footer.slot_dir
+        for i in sorted(range(len(slot_dir)), key=lambda slot_id: slot_dir[slot_id][0]):
+            offset, length = self.page_footer.slot_dir[i]
             # Skip deleted records
             if length != 0:
                 if offset != write_ptr:
                     self.data[write_ptr:write_ptr + length] = self.data[offset:offset + length]
-                self.page_footer.slot_dir[i] = (write_ptr, length)
                 # Update slots in bytes
-                new_slot_offset = Page.calculate_slot_offset(i)
-                self.data[new_slot_offset: new_slot_offset + OFFSET_SIZE] = write_ptr.to_bytes(OFFSET_SIZE, 'little')
-                self.data[new_slot_offset + OFFSET_SIZE: new_slot_offset + SLOT_ENTRY_SIZE] = length.to_bytes(
-                    LENGTH_SIZE, 'little')
+                self.write_slot(i, write_ptr, length)
                 write_ptr += length
 
             assert int.from_bytes(self.data[4092:4094], 'little') != 0, i
@@ -247,11 +388,452 @@ class Page:
             print(f"Record {i}: {int.from_bytes(record_bytes, 'little')}")
 
 
+class FixedPage:
+    """
+    Page for records of a fixed size, used for schemas without var_str.
+
+    Records are stored in fixed-size slots from the start of the page, slot i starts at i * record size. A bitmap
+    before the footer tracks which slots are in use, so there is no slot dir. and the page never needs compaction.
+    The footer contains the number of slots, with FIXED_PAGE_FLAG set to mark the page type, and the record size.
+    """
+
+    def __init__(self, data: bytearray = None, record_size: int = None):
+        if data is None:
+            self.data = bytearray(PAGE_SIZE)
+            self.record_size = record_size
+            self.capacity = FixedPage.calculate_capacity(record_size)
+            self.data[-FOOTER_SIZE:] = bytearray(
+                (self.capacity | FIXED_PAGE_FLAG).to_bytes(NUMBER_SLOTS_SIZE, 'little') + record_size.to_bytes(
+                    FREE_SPACE_POINTER_SIZE, 'little'))
+        else:
+            self.data = data
+            self.capacity = int.from_bytes(data[-FOOTER_SIZE:-FREE_SPACE_POINTER_SIZE], 'little') & ~FIXED_PAGE_FLAG
+            self.record_size = int.from_bytes(data[-FREE_SPACE_POINTER_SIZE:], 'little')
+        self.bitmap_offset = PAGE_SIZE - FOOTER_SIZE - (self.capacity + 7) // 8
+        self.used = sum(bin(byte).count('1') for byte in self.data[self.bitmap_offset:-FOOTER_SIZE])
+
+    @staticmethod
+    def calculate_capacity(record_size):
+        """
+        Every record takes its size plus one bit in the bitmap.
+        """
+        return (PAGE_SIZE - FOOTER_SIZE) * 8 // (record_size * 8 + 1)
+
+    def is_used(self, slot_id):
+        return self.data[self.bitmap_offset + slot_id // 8] >> (slot_id % 8) & 1
+
+    def set_used(self, slot_id, used: bool):
+        if used:
+            self.data[self.bitmap_offset + slot_id // 8] |= 1 << (slot_id % 8)
+        else:
+            self.data[self.bitmap_offset + slot_id // 8] &= ~(1 << (slot_id % 8)) & 0xFF
+
+    def free_space(self):
+        return (self.capacity - self.used) * self.record_size
+
+    def is_full(self):
+        return self.used == self.capacity
+
+    def insert_record(self, record: bytearray, slot_id=None, home: Tuple[int, int] = None) -> Optional[int]:
+        """
+        :return: Slot id of the inserted record, None if the page is full or the record has another size
+        """
+        if len(record) != self.record_size or home is not None or self.is_full():
+            return None
+        if slot_id is None:
+            # Find the first byte of the bitmap with a free slot
+            for i in range(self.bitmap_offset, PAGE_SIZE - FOOTER_SIZE):
+                if self.data[i] != 0xFF:
+                    byte = self.data[i]
+                    slot_id = (i - self.bitmap_offset) * 8 + ((byte + 1) & ~byte).bit_length() - 1
+                    break
+        elif self.is_used(slot_id):
+            return None
+
+        offset = slot_id * self.record_size
+        self.data[offset:offset + self.record_size] = record
+        self.set_used(slot_id, True)
+        self.used += 1
+        return slot_id
+
+    def delete_record(self, slot_id):
+        if self.is_used(slot_id):
+            self.set_used(slot_id, False)
+            self.used -= 1
+
+    def read_record(self, slot_id):
+        offset = slot_id * self.record_size
+        return self.data[offset: offset + self.record_size]
+
+    def update_record(self, slot_id, new_record):
+        """
+        Records have a fixed size, so an update is always in place.
+        """
+        if len(new_record) != self.record_size:
+            raise ValueError(f"Record of {len(new_record)} bytes doesn't match the record size {self.record_size}")
+        offset = slot_id * self.record_size
+        self.data[offset: offset + self.record_size] = new_record
+        return True
+
+    def fits(self, slot_id, record: bytearray) -> bool:
+        return len(record) == self.record_size
+
+    def can_forward(self, slot_id) -> bool:
+        # Records never grow, so they are never moved
+        return False
+
+    def find_record(self, byte_id: bytearray) -> int:
+        # We assume the first field is the id and an int, so search the id at the start of a slot
+        end = self.capacity * self.record_size
+        position = self.data.find(byte_id, 0, end)
+        while position != -1:
+            slot_id, rest = divmod(position, self.record_size)
+            if rest == 0 and self.is_used(slot_id):
+                return slot_id
+            position = self.data.find(byte_id, position + 1, end)
+
+    def iter_records(self):
+        for i in range(self.bitmap_offset, PAGE_SIZE - FOOTER_SIZE):
+            byte = self.data[i]
+            if byte == 0:
+                continue
+            for bit in range(8):
+                if byte >> bit & 1:
+                    slot_id = (i - self.bitmap_offset) * 8 + bit
+                    offset = slot_id * self.record_size
+                    yield slot_id, self.data[offset: offset + self.record_size]
+
+    def has_record(self, slot_id) -> bool:
+        return slot_id < self.capacity and bool(self.is_used(slot_id))
+
+    def forward_rid(self, slot_id) -> Optional[Tuple[int, int]]:
+        # Records never grow, so they are never moved
+        return None
+
+    def home_rid(self, slot_id) -> Optional[Tuple[int, int]]:
+        return None
+
+    def forwards(self):
+        return iter(())
+
+    def sort(self, index: int):
+        records = [record for _, record in self.iter_records()]
+        return sorted(records, key=lambda x: (x[index], x[0]))
+
+
+class PaxPage:
+    """
+    PAX page, the values of every column are stored together in a minipage, so a scan only reads the columns it needs.
+
+    Header at the start of the page: number of columns (1 byte), the type of every column (1 byte each) and the offset
+    of every minipage (2 bytes each). The minipages follow the header, a minipage of a fixed-width column is a packed
+    array of the values, a minipage of a var_str column contains an offset for every value (2 bytes each, plus one for
+    the end) followed by the concatenated values. Besides the columns of the schema, every page has two extra
+    minipages: the state of every row (deleted, live, forward pointer or moved) and a var. length value with the RID of
+    a forward pointer or the original RID of a moved record.
+    The footer contains the number of rows, with PAX_PAGE_FLAG set to mark the page type, and the used space.
+    """
+
+    def __init__(self, data: bytearray = None, schema: List[str] = None):
+        if data is None:
+            self.data = bytearray(PAGE_SIZE)
+            self.schema = list(schema)
+            self.row_count = 0
+        else:
+            self.data = data
+            self.schema = [PAX_TYPES[type_code] for type_code in data[1: 1 + data[0]]]
+            self.row_count = int.from_bytes(data[-FOOTER_SIZE:-FREE_SPACE_POINTER_SIZE], 'little') & ~PAX_PAGE_FLAG
+        # Schema columns + row state + RID of forward pointers and moved records
+        self.types = self.schema + ['byte', 'var_str']
+        self.state_column, self.rid_column = len(self.schema), len(self.schema) + 1
+        self.header_size = 1 + len(self.schema) + len(self.types) * MINIPAGE_OFFSET_SIZE
+        # Space of a forward pointer row
+        self.forward_space = self.row_space(self.empty_row(ROW_FORWARD, bytes(RID_SIZE)))
+        # Decoded columns, only used to rebuild the page after a change
+        self.columns = None
+        if data is None:
+            self.columns = [[] for _ in self.types]
+            self.serialize()
+        else:
+            self.used = int.from_bytes(data[-FREE_SPACE_POINTER_SIZE:], 'little')
+            self.minipages = [int.from_bytes(data[offset:offset + MINIPAGE_OFFSET_SIZE], 'little') for offset in
+                              range(1 + len(self.schema), self.header_size, MINIPAGE_OFFSET_SIZE)]
+
+    @staticmethod
+    def record_space(schema: List[str], record: bytearray, home: Tuple[int, int] = None) -> int:
+        """
+        Space a record takes on a PAX page, var_str values take an offset of 2 bytes instead of their 1 byte length.
+        """
+        var_columns = sum(1 for field_type in schema if field_type == 'var_str')
+        return len(record) + var_columns * (VAR_OFFSET_SIZE - 1) + 1 + VAR_OFFSET_SIZE + (
+            RID_SIZE if home is not None else 0)
+
+    def row_space(self, values: List[bytes]) -> int:
+        return sum(VAR_OFFSET_SIZE + len(value) if field_type == 'var_str' else len(value) for value, field_type in
+                   zip(values, self.types))
+
+    def split_record(self, record: bytearray) -> List[bytes]:
+        """
+        Split a record in the raw values of its fields, var_str values without their length.
+        """
+        values, position = [], 0
+        for field_type in self.schema:
+            if field_type == 'var_str':
+                length = record[position]
+                values.append(bytes(record[position + 1: position + 1 + length]))
+                position += 1 + length
+            else:
+                values.append(bytes(record[position: position + utils.FIELD_SIZES[field_type]]))
+                position += utils.FIELD_SIZES[field_type]
+        return values
+
+    def empty_row(self, state: int, rid: bytes = b'') -> List[bytes]:
+        """
+        Row of a deleted record or a forward pointer, fixed-width values are zero and var_str values are empty.
+        """
+        values = [b'' if field_type == 'var_str' else bytes(utils.FIELD_SIZES[field_type]) for field_type in
+                  self.schema]
+        return values + [bytes([state]), rid]
+
+    def value_range(self, column, slot_id) -> Tuple[int, int]:
+        """
+        :return: (start, end) of a value in the page
+        """
+        start = self.minipages[column]
+        if self.types[column] == 'var_str':
+            offset = start + slot_id * VAR_OFFSET_SIZE
+            blob = start + (self.row_count + 1) * VAR_OFFSET_SIZE
+            return (blob + int.from_bytes(self.data[offset:offset + VAR_OFFSET_SIZE], 'little'),
+                    blob + int.from_bytes(self.data[offset + VAR_OFFSET_SIZE:offset + 2 * VAR_OFFSET_SIZE], 'little'))
+        width = utils.FIELD_SIZES[self.types[column]]
+        return start + slot_id * width, start + (slot_id + 1) * width
+
+    def value(self, column, slot_id) -> bytes:
+        start, end = self.value_range(column, slot_id)
+        return bytes(self.data[start:end])
+
+    def state(self, slot_id) -> int:
+        return self.data[self.minipages[self.state_column] + slot_id]
+
+    def load_columns(self):
+        if self.columns is None:
+            self.columns = [[self.value(column, slot_id) for slot_id in range(self.row_count)] for column in
+                            range(len(self.types))]
+
+    def serialize(self):
+        """
+        Rebuild the page from the decoded columns.
+        """
+        header = bytearray([len(self.schema)] + [PAX_TYPES.index(field_type) for field_type in self.schema])
+        body = bytearray()
+        self.minipages = []
+        for field_type, values in zip(self.types, self.columns):
+            self.minipages.append(self.header_size + len(body))
+            if field_type == 'var_str':
+                offsets = itertools.accumulate((len(value) for value in values), initial=0)
+                body += struct.pack(f'<{len(values) + 1}H', *offsets)
+            body += b''.join(values)
+        for offset in self.minipages:
+            header += offset.to_bytes(MINIPAGE_OFFSET_SIZE, 'little')
+
+        self.row_count = len(self.columns[0])
+        self.used = self.header_size + len(body)
+        assert self.used <= PAGE_SIZE - FOOTER_SIZE
+        self.data[:self.used] = header + body
+        self.data[self.used:-FOOTER_SIZE] = bytearray(PAGE_SIZE - FOOTER_SIZE - self.used)
+        self.data[-FOOTER_SIZE:] = bytearray(
+            (self.row_count | PAX_PAGE_FLAG).to_bytes(NUMBER_SLOTS_SIZE, 'little') + self.used.to_bytes(
+                FREE_SPACE_POINTER_SIZE, 'little'))
+
+    def free_space(self):
+        return PAGE_SIZE - FOOTER_SIZE - self.used
+
+    def is_full(self):
+        return self.free_space() <= 0
+
+    def forward_reserve(self, values: List[bytes]) -> int:
+        """
+        Space a live row needs on top of its own space to be replaced by a forward pointer, a forward pointer takes
+        more space than a row with var_str values shorter than a RID.
+        """
+        if values[self.state_column] != bytes([ROW_LIVE]):
+            return 0
+        return max(0, self.forward_space - self.row_space(values))
+
+    def row_fits(self, slot_id, values: List[bytes], reserve: bool = True) -> bool:
+        """
+        Check if a row can replace the row in a slot (or be appended if slot_id == number of rows). A row that doesn't
+        grow always fits.
+
+        :param reserve: Every live row has to keep enough free space to be replaced by a forward pointer later on
+        """
+        self.load_columns()
+        old_values = [column[slot_id] for column in self.columns] if slot_id < self.row_count else None
+        growth = self.row_space(values) - (self.row_space(old_values) if old_values else 0)
+        if growth <= 0:
+            return True
+        if reserve:
+            growth += sum(self.forward_reserve(list(row)) for row in zip(*self.columns)) + self.forward_reserve(
+                values) - (self.forward_reserve(old_values) if old_values else 0)
+        return growth <= self.free_space()
+
+    def write_row(self, slot_id, values: List[bytes], reserve: bool = True) -> bool:
+        """
+        Replace (or append if slot_id == number of rows) a row and rebuild the page, if it fits.
+
+        :param reserve: See `row_fits`
+        """
+        if not self.row_fits(slot_id, values, reserve):
+            return False
+        self.load_columns()
+        for column, value in zip(self.columns, values):
+            if slot_id < self.row_count:
+                column[slot_id] = value
+            else:
+                column.append(value)
+        self.serialize()
+        return True
+
+    def insert_record(self, record: bytearray, slot_id=None, home: Tuple[int, int] = None) -> Optional[int]:
+        """
+        :return: Slot id of the inserted record, None if there was not enough space
+        """
+        if slot_id is None:
+            # Reuse the row of a deleted record, else append a new row
+            states = self.minipages[self.state_column]
+            slot_id = self.data.find(ROW_DELETED, states, states + self.row_count)
+            if slot_id == -1:
+                if PaxPage.record_space(self.schema, record, home) > self.free_space():
+                    return None
+                slot_id = self.row_count
+            else:
+                slot_id -= states
+        elif slot_id < self.row_count and self.state(slot_id) != ROW_DELETED:
+            return None
+        values = self.split_record(record)
+        if home is None:
+            values += [bytes([ROW_LIVE]), b'']
+        else:
+            values += [bytes([ROW_MOVED]), bytes(encode_rid(home))]
+        return slot_id if self.write_row(slot_id, values) else None
+
+    def delete_record(self, slot_id):
+        self.write_row(slot_id, self.empty_row(ROW_DELETED))
+
+    def read_record(self, slot_id):
+        """
+        Rebuild the record from the minipages, row-at-a-time.
+        """
+        record = bytearray()
+        for column, field_type in enumerate(self.schema):
+            value = self.value(column, slot_id)
+            if field_type == 'var_str':
+                record.append(len(value))
+            record += value
+        return record
+
+    def update_record(self, slot_id, new_record):
+        """
+        :return: True if the record was updated, False if the page doesn't have enough space for the new record
+        """
+        values = self.split_record(new_record)
+        return self.write_row(slot_id, values + [self.value(self.state_column, slot_id),
+                                                 self.value(self.rid_column, slot_id)])
+
+    def fits(self, slot_id, record: bytearray) -> bool:
+        """
+        Check if the row in this slot can be replaced by the record.
+        """
+        return self.row_fits(slot_id, self.split_record(record) + [bytes([ROW_LIVE]), b''])
+
+    def can_forward(self, slot_id) -> bool:
+        """
+        Check if the row in this slot can be replaced by a forward pointer.
+        """
+        return self.row_fits(slot_id, self.empty_row(ROW_FORWARD, bytes(RID_SIZE)), reserve=False)
+
+    def find_record(self, byte_id: bytearray) -> int:
+        # We assume the first field is the id and an int, so only the minipage of the first column is searched
+        start = self.minipages[0]
+        end = start + self.row_count * 4
+        position = self.data.find(byte_id, start, end)
+        while position != -1:
+            slot_id, rest = divmod(position - start, 4)
+            if rest == 0 and self.state(slot_id) in (ROW_LIVE, ROW_MOVED):
+                return slot_id
+            position = self.data.find(byte_id, position + 1, end)
+
+    def iter_records(self):
+        for slot_id in range(self.row_count):
+            if self.state(slot_id) in (ROW_LIVE, ROW_MOVED):
+                yield slot_id, self.read_record(slot_id)
+
+    def scan_columns(self, columns: List[int]) -> List[tuple]:
+        """
+        Decode only the minipages of the given columns.
+
+        :param columns: Column indices
+        :return: Values of the columns for every live record
+        """
+        states = self.data[self.minipages[self.state_column]:self.minipages[self.state_column] + self.row_count]
+        values = []
+        for column in columns:
+            field_type = self.types[column]
+            if field_type == 'var_str':
+                values.append([str(self.value(column, slot_id), 'utf-8') for slot_id in range(self.row_count)])
+            else:
+                fmt = f'<{self.row_count}{PAX_FORMATS[field_type]}'
+                values.append(struct.unpack_from(fmt, self.data, self.minipages[column]))
+        return [row for row, state in zip(zip(*values), states) if state in (ROW_LIVE, ROW_MOVED)]
+
+    def has_record(self, slot_id) -> bool:
+        return slot_id < self.row_count and self.state(slot_id) != ROW_DELETED
+
+    def forward_rid(self, slot_id) -> Optional[Tuple[int, int]]:
+        if self.state(slot_id) == ROW_FORWARD:
+            return decode_rid(self.value(self.rid_column, slot_id))
+        return None
+
+    def home_rid(self, slot_id) -> Optional[Tuple[int, int]]:
+        if self.state(slot_id) == ROW_MOVED:
+            return decode_rid(self.value(self.rid_column, slot_id))
+        return None
+
+    def forwards(self):
+        for slot_id in range(self.row_count):
+            if rid := self.forward_rid(slot_id):
+                yield slot_id, rid
+
+    def set_forward(self, slot_id, rid: Tuple[int, int]):
+        if not self.write_row(slot_id, self.empty_row(ROW_FORWARD, bytes(encode_rid(rid))), reserve=False):
+            raise ValueError(f"Not enough space for a forward pointer in slot {slot_id}")
+
+    def sort(self, index: int):
+        records = [record for _, record in self.iter_records()]
+        return sorted(records, key=lambda x: (x[index], x[0]))
+
+
+def load_page(data: bytearray):
+    """
+    Create the page object for the page type stored in the footer.
+    """
+    page_type = int.from_bytes(data[-FOOTER_SIZE:-FREE_SPACE_POINTER_SIZE], 'little')
+    if page_type & FIXED_PAGE_FLAG:
+        return FixedPage(data)
+    if page_type & PAX_PAGE_FLAG:
+        return PaxPage(data)
+    return Page(data)
+
+
 class PageDirectory(Page):
-    def __init__(self, file_path: str = None, data: bytearray = None, current_number: int = None):
+    def __init__(self, file_path: str = None, data: bytearray = None, current_number: int = None,
+                 schema: List[str] = None, layout: str = SLOTTED):
         self.data = bytearray(PAGE_SIZE) if data is None else data
         self.pages = {}  # Dictionary to store page information
         self.file_path = file_path
+        # Page layout of new data pages, see HeapFile
+        self.schema = schema
+        self.layout = layout
         super().__init__(self.data)
         # Information about page directories
         if data is None and current_number is None:
@@ -278,26 +860,58 @@ class PageDirectory(Page):
         if page_number in self.pages:
             return self.pages[page_number]
 
-        for offset, length in self.page_footer.slot_dir[1:]:
-            data = self.data[offset:offset + length]
-            if int.from_bytes(data[:PAGE_NUM_SIZE], 'little') == page_number:
+        # Free pages are skipped, their content on disk is stale
+        for number in self.page_numbers():
+            if number == page_number:
                 # TODO - reading from record that was inserted while file was open and doesn't exist yet gives error
                 assert self.file_path is not None
                 with open(self.file_path, "rb") as db:
                     db.seek(page_number * PAGE_SIZE)
-                    page = Page(bytearray(db.read(PAGE_SIZE)))
+                    page = load_page(bytearray(db.read(PAGE_SIZE)))
                     self.pages[page_number] = page
                     return page
 
-    def find_record(self, byte_id: bytearray) -> (int, int):
+    def entries(self) -> List[Tuple[int, int, bool]]:
+        """
+        Entries of all data pages tracked by this directory, first slot is skipped since it holds the dir. info
+
+        :return: List of (page number, free space, page is free)
+        """
+        entries = []
         for offset, length in self.page_footer.slot_dir[1:]:
-            page_number = int.from_bytes(self.data[offset: offset + PAGE_NUM_SIZE], 'little')
+            free_space = int.from_bytes(self.data[offset + PAGE_NUM_SIZE: offset + length], 'little')
+            entries.append((int.from_bytes(self.data[offset: offset + PAGE_NUM_SIZE], 'little'),
+                            free_space & ~FREE_PAGE_FLAG, bool(free_space & FREE_PAGE_FLAG)))
+        return entries
+
+    def page_numbers(self) -> List[int]:
+        """
+        Page numbers of all data pages in use, free pages are skipped
+        """
+        return [page_number for page_number, _, free in self.entries() if not free]
+
+    def find_rid(self, byte_id: bytearray) -> Optional[Tuple[int, int]]:
+        """
+        :return: RID (page number, slot id) where the record with this id is stored, None if not in this directory
+        """
+        for page_number in self.page_numbers():
             page: Page = self.find_page(page_number)
-            record = page.find_record(byte_id)
-            if record is not None:
-                return page, record
+            slot_id = page.find_record(byte_id)
+            if slot_id is not None:
+                return page_number, slot_id
+        return None
+
+    def find_record(self, byte_id: bytearray) -> (int, int):
+        if rid := self.find_rid(byte_id):
+            return self.pages[rid[0]], rid[1]
         return False
 
+    def contains_page(self, page_number) -> bool:
+        """
+        Data pages of a directory are numbered consecutively after the directory itself.
+        """
+        return self.pd_number < page_number < self.pd_number + self.page_footer.slot_count()
+
     def find_or_create_data_page_for_insert(self, needed_space):
 
         page_num = 0
@@ -309,6 +923,13 @@ class PageDirectory(Page):
             record = self.data[offset: offset + length]
             page_num, free_space = int.from_bytes(record[:PAGE_NUM_SIZE], 'little'), int.from_bytes(
                 record[FREE_SPACE_SIZE:], 'little')
+            # Reuse a free page, it starts empty
+            if free_space & FREE_PAGE_FLAG:
+                self.reuse_page(page_num)
+                return True
+            # Pages in memory were already tried, don't read them from disk again
+            if page_num in self.pages:
+                continue
             if needed_space <= free_space:
                 break
 
@@ -319,7 +940,7 @@ class PageDirectory(Page):
             if (PAGE_NUM_SIZE + FREE_SPACE_SIZE) + SLOT_ENTRY_SIZE > self.free_space():
                 return False
 
-            page = Page()
+            page = self.new_page()
             # Find the max. current page number
             page_num = int.from_bytes(self.read_record(len(self.page_footer.slot_dir) - 1)[:PAGE_NUM_SIZE],
                                       'little') + 1
@@ -334,30 +955,80 @@ class PageDirectory(Page):
         assert self.file_path is not None
         with open(self.file_path, "rb") as db:
             db.seek(page_num * PAGE_SIZE)
-            page = Page(bytearray(db.read(PAGE_SIZE)))
+            page = load_page(bytearray(db.read(PAGE_SIZE)))
 
         self.pages[page_num] = page
         return True
 
+    def new_page(self):
+        if self.layout != SLOTTED and self.schema is None:
+            raise ValueError(f"Page layout {self.layout} needs a schema")
+        if self.layout == FIXED:
+            return FixedPage(record_size=utils.fixed_record_size(self.schema))
+        if self.layout == PAX:
+            return PaxPage(schema=self.schema)
+        return Page()
+
+    def set_next_dir(self, next_dir):
+        self.next_dir = next_dir
+        # (current_pd_number, next_pd_number)
+        self.data[PAGE_NUM_SIZE:PAGE_NUM_SIZE + FREE_SPACE_SIZE] = next_dir.to_bytes(FREE_SPACE_SIZE, 'little')
+
+    def reuse_page(self, page_number) -> Page:
+        """
+        Replace a free data page with a new empty page.
+        """
+        page = self.pages[page_number] = self.new_page()
+        self.update_free_space(page_number, page.free_space())
+        return page
+
     def delete_data_page(self, page_number):
-        # Mark a data page as free in the directory
-        if page_number in self.pages:
-            self.pages[page_number]['status'] = 'free'
-            print(f"Deleted data page {page_number}")
+        """
+        Mark a data page as free in the directory, it is reused for a new page before the file grows.
+        """
+        self.pages.pop(page_number, None)
+        self.update_free_space(page_number, FREE_PAGE_FLAG)
 
-    def insert_record(self, data: bytearray):
+    def drop_last_entry(self):
+        """
+        Remove the entry of the last data page, only valid in the last directory of the chain since the data pages of
+        a directory are numbered consecutively.
+        """
+        page_number = self.entries()[-1][0]
+        self.pages.pop(page_number, None)
+        self.page_footer.slot_dir.pop()
+        self.page_footer.slot_flags.pop()
+        self.compact_page()
+        return page_number
+
+    def insert_record(self, data: bytearray, home: Tuple[int, int] = None):
+        """
+        :param data: Record
+        :param home: Original RID if the record is moved away from its page, see `Page.insert_record`
+        :return: RID (page number, slot id) of the inserted record, False if this directory is full
+        """
         for nr, page in self.pages.items():
             if page.is_full():
                 # self.full_pages.append(self.pages.pop(page_number))
                 continue
 
-            elif page.insert_record(data):
+            elif (slot_id := page.insert_record(data, home=home)) is not None:
                 self.update_free_space(nr, page.free_space())
-                return True  # Tuple written successfully
+                return nr, slot_id  # Tuple written successfully
         # All existing pages are full, create a new page and write the tuple
-        if not self.find_or_create_data_page_for_insert(len(data) + SLOT_ENTRY_SIZE):
+        if not self.find_or_create_data_page_for_insert(self.needed_space(data, home)):
             return False
-        return self.insert_record(data)
+        return self.insert_record(data, home)
+
+    def needed_space(self, data: bytearray, home: Tuple[int, int] = None) -> int:
+        """
+        Free space a data page of this directory needs to store the record.
+        """
+        if self.layout == FIXED:
+            return utils.fixed_record_size(self.schema)
+        if self.layout == PAX:
+            return PaxPage.record_space(self.schema, data, home)
+        return len(data) + SLOT_ENTRY_SIZE + (RID_SIZE if home is not None else 0)
 
     def update_free_space(self, page_nr, free_space):
         # TODO NOW - Calculate relative page_nr inside page dir.
@@ -366,47 +1037,495 @@ class PageDirectory(Page):
         self.data[offset + PAGE_NUM_SIZE:offset + PAGE_NUM_SIZE + FREE_SPACE_SIZE] = free_space.to_bytes(
             FREE_SPACE_SIZE, 'little')
 
-    def list_free_pages(self):
-        return [page for page, info in self.pages.items() if info['status'] == 'free']
+    def list_free_pages(self) -> List[int]:
+        return [page_number for page_number, _, free in self.entries() if free]
+
+
+class FileHeader:
+    """
+    First page of a heap file with a compact summary of the chain of page directories, so a data page can be mapped
+    to its directory without walking the chain.
+
+    The header also stores the page layout of the file and its schema, so a file keeps its layout when it's opened
+    without them.
+
+    Layout: magic (8 bytes), version (1 byte), page layout (1 byte), number of columns (2 bytes), type code of every
+    column (1 byte each), number of runs (2 bytes) and the runs. Version 1 headers have no layout and schema.
+    Directories are stored as runs (first directory, distance between directories, number of directories) of 3 bytes
+    each, directories that are created one after the other when the previous one is full are evenly spaced and form
+    a single run. If the runs don't fit in the page, the number of runs is set to NO_SUMMARY and the chain is walked
+    instead.
+    """
+    MAGIC = b'HEAPFILE'
+    VERSION = 2
+    NO_SUMMARY = 0xFFFF
+    RUN_SIZE = 3 * PAGE_NUM_SIZE
+    LAYOUTS = (SLOTTED, FIXED, PAX)
+
+    def __init__(self, data: bytearray = None, layout: str = None, schema: List[str] = None):
+        # Page numbers of the page directories, None if the summary is missing
+        self.directories: Optional[List[int]] = []
+        # Page layout and schema of the file, None in a version 1 header
+        self.layout = layout
+        self.schema = schema
+        if data is None:
+            return
+        offset = 9
+        if data[8] >= 2:
+            self.layout = FileHeader.LAYOUTS[data[9]]
+            column_count = int.from_bytes(data[10:12], 'little')
+            self.schema = [PAX_TYPES[type_code] for type_code in data[12:12 + column_count]] or None
+            offset = 12 + column_count
+        run_count = int.from_bytes(data[offset:offset + 2], 'little')
+        offset += 2
+        if run_count == FileHeader.NO_SUMMARY:
+            self.directories = None
+            return
+        for i in range(run_count):
+            run = data[offset + i * FileHeader.RUN_SIZE: offset + (i + 1) * FileHeader.RUN_SIZE]
+            start, stride, count = (int.from_bytes(run[j:j + PAGE_NUM_SIZE], 'little') for j in
+                                    range(0, FileHeader.RUN_SIZE, PAGE_NUM_SIZE))
+            self.directories.extend(start + k * stride for k in range(count))
+
+    @staticmethod
+    def is_header(data: bytearray) -> bool:
+        return data[:len(FileHeader.MAGIC)] == FileHeader.MAGIC
+
+    def data(self) -> bytearray:
+        runs = []
+        for number in self.directories or []:
+            if runs and runs[-1][2] == 1:
+                # Second directory of a run fixes the distance
+                runs[-1][1], runs[-1][2] = number - runs[-1][0], 2
+            elif runs and number == runs[-1][0] + runs[-1][1] * runs[-1][2]:
+                runs[-1][2] += 1
+            else:
+                runs.append([number, 0, 1])
+
+        schema = self.schema or []
+        data = bytearray(PAGE_SIZE)
+        data[:12] = FileHeader.MAGIC + bytes([FileHeader.VERSION, FileHeader.LAYOUTS.index(self.layout)]) + len(
+            schema).to_bytes(2, 'little')
+        data[12:12 + len(schema)] = bytes(PAX_TYPES.index(field_type) for field_type in schema)
+        offset = 12 + len(schema)
+        if self.directories is None or offset + 2 + len(runs) * FileHeader.RUN_SIZE > PAGE_SIZE:
+            data[offset:offset + 2] = FileHeader.NO_SUMMARY.to_bytes(2, 'little')
+            return data
+        data[offset:offset + 2] = len(runs).to_bytes(2, 'little')
+        offset += 2
+        for i, run in enumerate(runs):
+            data[offset + i * FileHeader.RUN_SIZE: offset + (i + 1) * FileHeader.RUN_SIZE] = b''.join(
+                value.to_bytes(PAGE_NUM_SIZE, 'little') for value in run)
+        return data
 
 
 class HeapFile:
-    def __init__(self, file_path):
+    def __init__(self, file_path, schema: List[str] = None, layout: str = None):
+        """
+        :param file_path: Heap file
+        :param schema: Schema of the records
+        :param layout: Page layout of new data pages: SLOTTED, FIXED or PAX (needs the schema). If None, FIXED is used
+                       for a schema without var_str and SLOTTED otherwise. Every page stores its type, so pages of
+                       different layouts can be mixed in one file.
+                       The layout and schema are only used to create a file, they are stored in the file header and
+                       an existing file keeps them. Files without them in the header use the layout of their first
+                       data page.
+        """
         self.file_path = file_path
+        # Files without a header (older files) start with the first page directory
+        self.header: Optional[FileHeader] = None
         if os.path.isfile(file_path):
             with open(file_path, 'rb') as db:
-                pd = PageDirectory(file_path=file_path, data=bytearray(db.read(PAGE_SIZE)))
+                data = bytearray(db.read(PAGE_SIZE))
+                if FileHeader.is_header(data):
+                    self.header = FileHeader(data)
+                    data = bytearray(db.read(PAGE_SIZE))
+            if self.header is not None and self.header.layout is not None:
+                if layout is not None and layout != self.header.layout:
+                    raise ValueError(f"File {file_path} has page layout {self.header.layout}, not {layout}")
+                if schema is not None and self.header.schema is not None and list(schema) != self.header.schema:
+                    raise ValueError(f"File {file_path} has schema {self.header.schema}, not {schema}")
+                self.schema, self.layout = self.header.schema or schema, self.header.layout
+            else:
+                self.schema = schema
+                self.layout = SLOTTED
+            pd = PageDirectory(file_path=file_path, data=data, schema=self.schema, layout=self.layout)
+            if self.header is None or self.header.layout is None:
+                self.infer_layout(pd)
         else:
-            pd = PageDirectory()
+            if layout is None:
+                layout = FIXED if schema is not None and utils.fixed_record_size(schema) is not None else SLOTTED
+            if layout != SLOTTED and schema is None:
+                raise ValueError(f"Page layout {layout} needs a schema")
+            self.schema, self.layout = schema, layout
+            # First page is the file header, the first page directory follows it
+            self.header = FileHeader(layout=layout, schema=schema)
+            self.header.directories.append(1)
+            pd = PageDirectory(file_path=file_path, current_number=0, schema=schema, layout=layout)
         self.page_directories: list[PageDirectory] = [pd]
+        # (phase, page number) where the next call of `vacuum` continues, None to start from the beginning
+        self.vacuum_cursor: Optional[Tuple[str, Optional[int]]] = None
+
+    def infer_layout(self, pd: PageDirectory):
+        """
+        Take the page layout (and the schema of PAX pages) from the first data page, for files without them in the
+        header. The layout is stored in the header when the file is closed.
+        """
+        if page_numbers := pd.page_numbers():
+            page = pd.find_page(page_numbers[0])
+            if isinstance(page, FixedPage):
+                self.layout = FIXED
+            elif isinstance(page, PaxPage):
+                self.layout, self.schema = PAX, self.schema or page.schema
+        pd.schema, pd.layout = self.schema, self.layout
+        if self.header is not None:
+            self.header.layout, self.header.schema = self.layout, self.schema
 
     def read_page_dir(self, pd: PageDirectory) -> PageDirectory:
-        if new_pd := list(filter(lambda pgd: pgd.pd_number == pd.next_dir, self.page_directories)):
+        return self.load_page_dir(pd.next_dir)
+
+    def load_page_dir(self, pd_number) -> PageDirectory:
+        if new_pd := list(filter(lambda pgd: pgd.pd_number == pd_number, self.page_directories)):
             return new_pd[0]
 
         with open(self.file_path, 'rb') as db:
-            db.seek(pd.next_dir * PAGE_SIZE)
-            new_pd = PageDirectory(file_path=self.file_path, data=bytearray(db.read(PAGE_SIZE)))
+            db.seek(pd_number * PAGE_SIZE)
+            new_pd = PageDirectory(file_path=self.file_path, data=bytearray(db.read(PAGE_SIZE)), schema=self.schema,
+                                   layout=self.layout)
         self.page_directories.append(new_pd)
         return new_pd
 
-    def delete_record(self, page_id, slot_id):
-        if page_id < len(self.pages):
-            self.pages[page_id].delete_record(slot_id)
+    def find_page_dir(self, page_number) -> Optional[PageDirectory]:
+        """
+        Find the page directory that tracks a data page. With the summary in the file header only that directory is
+        read, otherwise the chain is walked.
+        """
+        if self.header is not None and self.header.directories:
+            # Directories track the data pages that follow them, so take the last directory before the page
+            i = bisect.bisect_right(self.header.directories, page_number) - 1
+            if i < 0:
+                return None
+            pd = self.load_page_dir(self.header.directories[i])
+            return pd if pd.contains_page(page_number) else None
+
+        for pd in self.iter_page_dirs():
+            if pd.contains_page(page_number):
+                return pd
+        return None
+
+    def get_page(self, page_number) -> Page:
+        """
+        Get a data page, it's kept in memory until the file is closed.
+
+        :raises KeyError: If the page doesn't exist (anymore), e.g. it was freed or truncated by the vacuum
+        """
+        pd = self.find_page_dir(page_number)
+        if pd is None or (page := pd.find_page(page_number)) is None:
+            raise KeyError(f"Page {page_number} doesn't exist")
+        return page
+
+    def read_page(self, page_number) -> Page:
+        """
+        Get a data page without keeping it in memory, a page that is already in memory is used as is.
+
+        :raises KeyError: If the page doesn't exist (anymore)
+        """
+        pd = self.find_page_dir(page_number)
+        if pd is None or page_number not in pd.page_numbers():
+            raise KeyError(f"Page {page_number} doesn't exist")
+        if page_number in pd.pages:
+            return pd.pages[page_number]
+        with open(self.file_path, 'rb') as db:
+            db.seek(page_number * PAGE_SIZE)
+            return load_page(bytearray(db.read(PAGE_SIZE)))
+
+    def update_free_space(self, page_number):
+        pd = self.find_page_dir(page_number)
+        pd.update_free_space(page_number, pd.pages[page_number].free_space())
+
+    def locate(self, byte_id: bytearray) -> Optional[Tuple[int, int]]:
+        """
+        Find the RID of a record, for a moved record this is the RID of its forward pointer, which never changes.
+
+        :return: RID (page number, slot id), None if the record doesn't exist
+        """
+        for pd in self.iter_page_dirs():
+            if rid := pd.find_rid(byte_id):
+                return pd.pages[rid[0]].home_rid(rid[1]) or rid
+        return None
+
+    def read_rid(self, rid: Tuple[int, int]):
+        """
+        Read a record by RID, a forward pointer is followed at most once.
+
+        :raises KeyError: If there is no record with this RID
+        """
+        page = self.get_page(rid[0])
+        if not page.has_record(rid[1]):
+            raise KeyError(f"No record with RID {rid}")
+        if forward := page.forward_rid(rid[1]):
+            return self.get_page(forward[0]).read_record(forward[1])
+        return page.read_record(rid[1])
+
+    def delete_rid(self, rid: Tuple[int, int]):
+        page = self.get_page(rid[0])
+        if forward := page.forward_rid(rid[1]):
+            self.get_page(forward[0]).delete_record(forward[1])
+            self.update_free_space(forward[0])
+        page.delete_record(rid[1])
+        self.update_free_space(rid[0])
+
+    def update_rid(self, rid: Tuple[int, int], data: bytearray):
+        """
+        Update a record by RID, the RID stays valid. A record that grows and doesn't fit on its page anymore is moved
+        to another page and a forward pointer to its new RID is left in its original slot. If the record was already
+        moved, the forward pointer is updated, so there is never more than one hop.
+
+        The update either completes or leaves the file unchanged, a ValueError is raised if the record can't be moved.
+        """
+        page_nr, slot_id = rid
+        page = self.get_page(page_nr)
+        forward = page.forward_rid(slot_id)
+
+        if forward is None:
+            if not page.update_record(slot_id, data):
+                # Not enough free space on page, move the record to a new page if a forward pointer can be left behind
+                if not page.can_forward(slot_id):
+                    raise ValueError(f"Not enough space for a forward pointer in slot {slot_id} of page {page_nr}")
+                page.set_forward(slot_id, self.insert_record(data, home=rid))
+            self.update_free_space(page_nr)
+            return True
+
+        # Record was moved before, try to update it where it is now
+        forward_page = self.get_page(forward[0])
+        if not forward_page.update_record(forward[1], data):
+            if page.fits(slot_id, data):
+                # Record fits on its original page again, replace the forward pointer by the record
+                forward_page.delete_record(forward[1])
+                page.delete_record(slot_id)
+                page.insert_record(data, slot_id)
+            else:
+                # Insert the new copy before deleting the old one, the forward pointer keeps its size
+                new_rid = self.insert_record(data, home=rid)
+                forward_page.delete_record(forward[1])
+                page.set_forward(slot_id, new_rid)
+            self.update_free_space(page_nr)
+        self.update_free_space(forward[0])
+        return True
+
+    def delete_record(self, byte_id: bytearray):
+        rid = self.locate(byte_id)
+        if rid is None:
+            print('Record not found!')
+            return
+        self.delete_rid(rid)
 
     def update_record(self, byte_id: bytearray, data):
-        page, slot_id = self.find_record(byte_id)
-        if page.update_record(slot_id, data):
+        rid = self.locate(byte_id)
+        if rid is None:
+            print('Record not found!')
+            return
+        return self.update_rid(rid, data)
+
+    def collapse_forward(self, page_nr, slot_id, forward: Tuple[int, int]) -> bool:
+        """
+        Move a record back to its original page if it has enough free space again, this removes the forward pointer.
+        """
+        record = self.read_page(forward[0]).read_record(forward[1])
+        if not self.read_page(page_nr).fits(slot_id, record):
+            return False
+        page = self.get_page(page_nr)
+        forward_page = self.get_page(forward[0])
+        forward_page.delete_record(forward[1])
+        page.delete_record(slot_id)
+        page.insert_record(record, slot_id)
+        self.update_free_space(forward[0])
+        self.update_free_space(page_nr)
+        return True
+
+    def collapse_forwards(self):
+        for page_nr in self.data_page_numbers():
+            for slot_id, forward in list(self.read_page(page_nr).forwards()):
+                self.collapse_forward(page_nr, slot_id, forward)
+
+    def vacuum(self, max_steps: int = None, relocate: bool = False) -> bool:
+        """
+        Online vacuum, runs in bounded steps so it can be interleaved with other operations. Every call continues
+        where the previous one stopped (`vacuum_cursor`), pages are only kept in memory when they are changed.
+        1. collapse: from the start of the file, records are moved back to their original page if they fit again
+        2. drain: from the end of the file, empty pages are marked free in their directory so they are reused before
+           the file grows. Sparse pages that only hold moved records are drained into the fullest pages before them,
+           only the forward pointers of these records are updated, so their RIDs stay valid.
+        3. trim: free pages and empty directories at the end of the chain are dropped and the file is truncated
+
+        With `relocate`, sparse pages with other records are drained as well and the records of the last pages are
+        moved into the free space before them before trimming, like VACUUM FULL. These records get a new RID, so only
+        use it when nothing holds on to RIDs. Pages with forward pointers are never emptied.
+
+        :param max_steps: Maximum number of data pages that are visited in this call, None runs until done
+        :param relocate: Also move records that were never moved, this changes their RID
+        :return: True if the vacuum is done, False if it continues in the next call
+        """
+        phase, position = self.vacuum_cursor or (VACUUM_COLLAPSE, 0)
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if phase == VACUUM_COLLAPSE:
+                page_nr = self.next_data_page(position)
+                if page_nr is None:
+                    phase, position = VACUUM_DRAIN, None
+                    continue
+                for slot_id, forward in list(self.read_page(page_nr).forwards()):
+                    self.collapse_forward(page_nr, slot_id, forward)
+                position = page_nr + 1
+            elif phase == VACUUM_DRAIN:
+                page_nr = self.previous_data_page(position)
+                if page_nr is None:
+                    phase = VACUUM_TRIM
+                    continue
+                self.vacuum_page(page_nr, relocate)
+                position = page_nr - 1
+            else:
+                self.trim()
+                # Move the last page into the free space before it, so the next step can cut it off
+                page_numbers = self.data_page_numbers() if relocate else []
+                if not page_numbers or not self.drain_page(page_numbers[-1], relocate=True, reuse_free=True):
+                    self.vacuum_cursor = None
+                    return True
+            steps += 1
+        self.vacuum_cursor = phase, position
+        return False
+
+    def next_data_page(self, page_number) -> Optional[int]:
+        """
+        :return: First data page in use with a number >= page_number, None if there is none
+        """
+        for pd in self.iter_page_dirs():
+            # Data pages of a directory are numbered consecutively after it
+            if pd.pd_number + pd.page_footer.slot_count() <= page_number:
+                continue
+            for number in pd.page_numbers():
+                if number >= page_number:
+                    return number
+        return None
+
+    def previous_data_page(self, page_number: Optional[int]) -> Optional[int]:
+        """
+        :return: Last data page in use with a number <= page_number (or the last one if None), None if there is none
+        """
+        for pd in reversed(list(self.iter_page_dirs())):
+            if page_number is not None and pd.pd_number >= page_number:
+                continue
+            for number in reversed(pd.page_numbers()):
+                if page_number is None or number <= page_number:
+                    return number
+        return None
+
+    def vacuum_page(self, page_nr, relocate: bool = False) -> bool:
+        """
+        Drain step of the vacuum for one page: an empty page is marked free, a sparse page is drained.
+
+        :return: True if the page changed
+        """
+        page = self.read_page(page_nr)
+        if any(page.forwards()):
+            return False
+        if next(page.iter_records(), None) is None:
+            self.find_page_dir(page_nr).delete_data_page(page_nr)
             return True
-        else:
-            # Not enough free space on page, try to find a new page
-            self.page_directories[0].insert_record(data)
+        if page.free_space() < (PAGE_SIZE - FOOTER_SIZE) * VACUUM_SPARSE_FRACTION:
+            return False
+        return self.drain_page(page_nr, relocate)
+
+    def drain_page(self, page_nr, relocate: bool = False, reuse_free: bool = False) -> bool:
+        """
+        Move the records of a page to the fullest pages before it that have enough space, the page is marked free
+        when it is empty. Moved records keep their RID, since only their forward pointer is updated.
+
+        :param relocate: Also move records that were never moved, they get a new RID. Without it, a page with such
+                         records isn't drained.
+        :param reuse_free: Free pages are used as well, only if all records fit in the pages before this one
+        :return: True if records were moved
+        """
+        page = self.read_page(page_nr)
+        records = [(slot_id, record, page.home_rid(slot_id)) for slot_id, record in page.iter_records()]
+        if any(page.forwards()) or (not relocate and any(home is None for _, _, home in records)):
+            return False
+        # Free space of the candidate pages, the fullest page that fits is used first
+        empty_space = self.page_directories[0].new_page().free_space() if reuse_free else 0
+        targets = {number: empty_space if free else free_space for pd in self.iter_page_dirs()
+                   for number, free_space, free in pd.entries() if number < page_nr and (reuse_free or not free)}
+        if reuse_free and sum(targets.values()) < empty_space - page.free_space():
+            return False
+
+        page = self.get_page(page_nr)
+        moved = False
+        for slot_id, record, home in records:
+            needed_space = self.page_directories[0].needed_space(record, home)
+            new_rid = None
+            for number in sorted((number for number, free_space in targets.items() if free_space >= needed_space),
+                                 key=lambda number: targets[number]):
+                if home is not None and number == home[0]:
+                    continue
+                pd = self.find_page_dir(number)
+                target = pd.find_page(number) if number in pd.page_numbers() else pd.reuse_page(number)
+                new_slot = target.insert_record(record, home=home)
+                self.update_free_space(number)
+                targets[number] = target.free_space()
+                if new_slot is not None:
+                    new_rid = number, new_slot
+                    break
+            if new_rid is None:
+                break
+            page.delete_record(slot_id)
+            if home is not None:
+                self.get_page(home[0]).set_forward(home[1], new_rid)
+            moved = True
+
+        if next(page.iter_records(), None) is None:
+            self.find_page_dir(page_nr).delete_data_page(page_nr)
+            return True
+        self.update_free_space(page_nr)
+        return moved
+
+    def trim(self) -> bool:
+        """
+        Drop the free pages at the end of the last directory and directories without data pages at the end of the
+        chain, rewrite the summary in the header and truncate the file.
+
+        :return: True if the file got shorter
+        """
+        trimmed = False
+        while True:
+            page_dirs = list(self.iter_page_dirs())
+            last = page_dirs[-1]
+            entries = last.entries()
+            if entries and entries[-1][2]:
+                last.drop_last_entry()
+            elif not entries and len(page_dirs) > 1:
+                page_dirs[-2].set_next_dir(0)
+                self.page_directories.remove(last)
+                if self.header is not None and self.header.directories is not None:
+                    self.header.directories.remove(last.pd_number)
+            else:
+                break
+            trimmed = True
 
-    def insert_record(self, data):
+        if trimmed and os.path.isfile(self.file_path):
+            end = (entries[-1][0] if entries else last.pd_number) + 1
+            if os.path.getsize(self.file_path) > end * PAGE_SIZE:
+                os.truncate(self.file_path, end * PAGE_SIZE)
+        return trimmed
+
+    def insert_record(self, data, home: Tuple[int, int] = None) -> Tuple[int, int]:
+        """
+        :param data: Record
+        :param home: Original RID if the record is moved away from its page
+        :return: RID (page number, slot id) of the inserted record
+        """
         pd: PageDirectory = self.page_directories[0]
 
         # Iterate over all page dir., if full move to the next one
-        while not (inserted := pd.insert_record(data)) and pd.next_dir != 0:
+        while not (inserted := pd.insert_record(data, home)) and pd.next_dir != 0:
             pd = self.read_page_dir(pd)
 
         # If last dir. is full, create new one
@@ -414,13 +1533,14 @@ class HeapFile:
             # Find the max. current page number
             max_page_nr = int.from_bytes(pd.read_record(len(pd.page_footer.slot_dir) - 1)[:PAGE_NUM_SIZE], 'little')
             # Create new page directory
-            new_pd = PageDirectory(file_path=self.file_path, current_number=max_page_nr)
-            pd.next_dir = new_pd.pd_number
-            # (current_pd_number, next_pd_number)
-            pd.data[PAGE_NUM_SIZE:PAGE_NUM_SIZE + FREE_SPACE_SIZE] = pd.next_dir.to_bytes(FREE_SPACE_SIZE, 'little')
+            new_pd = PageDirectory(file_path=self.file_path, current_number=max_page_nr, schema=self.schema,
+                                   layout=self.layout)
+            pd.set_next_dir(new_pd.pd_number)
             self.page_directories.append(new_pd)
-            return new_pd.insert_record(data)
-        return True
+            if self.header is not None and self.header.directories is not None:
+                self.header.directories.append(new_pd.pd_number)
+            return new_pd.insert_record(data, home)
+        return inserted
 
     def find_record(self, byte_id: bytearray) -> (int, int):
         pd: PageDirectory = self.page_directories[0]
@@ -441,6 +1561,65 @@ class HeapFile:
             return
         return page.read_record(slot_id)
 
+    def iter_pages(self):
+        """
+        Iterate over all data pages, following the chain of page directories.
+        Pages that are already in memory are used as is, others are read from disk without caching them, so a scan
+        never keeps more than one page in memory.
+        """
+        db = open(self.file_path, 'rb') if os.path.isfile(self.file_path) else None
+        try:
+            for pd in self.iter_page_dirs():
+                for page_nr in pd.page_numbers():
+                    page = pd.pages.get(page_nr)
+                    if page is None:
+                        db.seek(page_nr * PAGE_SIZE)
+                        page = load_page(bytearray(db.read(PAGE_SIZE)))
+                    yield page
+        finally:
+            if db is not None:
+                db.close()
+
+    def scan(self):
+        """
+        Sequential scan over all records of the heap file.
+
+        :return: Generator of records
+        """
+        for page in self.iter_pages():
+            for _, record in page.iter_records():
+                yield record
+
+    def scan_columns(self, schema: List[str], columns: List[int]):
+        """
+        Sequential scan of only some columns, on PAX pages only the minipages of these columns are read.
+
+        :param schema: Schema of the records
+        :param columns: Column indices
+        :return: Generator of tuples with the values of the columns
+        """
+        for page in self.iter_pages():
+            if isinstance(page, PaxPage):
+                yield from page.scan_columns(columns)
+                continue
+            for _, record in page.iter_records():
+                row = utils.decode_record(record, schema)
+                yield tuple(row[column] for column in columns)
+
+    def iter_page_dirs(self):
+        """
+        Iterate over the chain of page directories, directories that aren't loaded yet are read from disk.
+        """
+        pd: PageDirectory = self.page_directories[0]
+        while True:
+            yield pd
+            if pd.next_dir == 0:
+                break
+            pd = self.read_page_dir(pd)
+
+    def data_page_numbers(self) -> List[int]:
+        return [page_nr for pd in self.iter_page_dirs() for page_nr in pd.page_numbers()]
+
     def find_page(self, page_number):
         for page_directory in self.page_directories:
             if page := page_directory.find_page(page_number):
@@ -452,7 +1631,12 @@ class HeapFile:
             with open(self.file_path, 'wb') as file:
                 file.close()
         print("closing")
+        if self.header is not None and self.header.directories is None:
+            # Rebuild the summary, the header can hold it again if the chain got shorter
+            self.header.directories = [pd.pd_number for pd in self.iter_page_dirs()]
         with open(self.file_path, 'r+b') as file:
+            if self.header is not None:
+                file.write(self.header.data())
             for page_dir in self.page_directories:
                 file.seek(page_dir.pd_number * PAGE_SIZE)
                 file.write(page_dir.data)
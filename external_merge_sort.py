@@ -1,128 +1,313 @@
+import itertools
 import os
 import pickle
-from typing import List, Tuple
+import queue
+import tempfile
+import threading
+from typing import List, Tuple, Iterable, Iterator, Callable, Any
 
 from database import Page
 
+# Number of entries that are (un)pickled at once when streaming a run file, the equivalent of one page in the merge
+BLOCK_SIZE = 512
+# Number of entries that are sorted in memory during phase 0
+RUN_SIZE = 8 * BLOCK_SIZE
+# Number of blocks that are read ahead per input run and written behind for the output run during a merge,
+# a 2-way merge keeps at most 2 * (1 + PREFETCH) + (1 + PREFETCH) blocks in memory
+PREFETCH = 2
+
+_DONE = object()
 
-def two_way_external_merge_sort(pages: List[Page], key: int):
-    # Phase 0: Sort individual pages
-
-    merged_files: List[Tuple[str]] = []
-
-    for i, page in enumerate(pages[:7]):
-        run = page.sort(key)
-        run = [(entry[key], entry) for entry in run]
-        # write to file
-
-        with open(str(i) + '_0', 'wb') as f:
-            pickle.dump(run, f)
-            merged_files.append((str(i),))
-
-    def merge_pages(bucket1: tuple[str], bucket2: tuple[str]):
-        bucket1Index = 0
-        bucket2Index = 0
-        with open(f'{bucket1[bucket1Index]}_{len(bucket1) // 2}', 'rb') as f1, open(
-                f'{bucket2[bucket2Index]}_{len(bucket1) // 2}', 'rb') as f2:
-            run1 = pickle.load(f1)
-            run2 = pickle.load(f2)
-
-        name_iter = iter((*bucket1, *bucket2))
-        iter1 = iter(run1)
-        iter2 = iter(run2)
-        a = next(iter1)
-        b = next(iter2)
-        empty = [False, False]
-        r = max(len(run1), len(run2))
-        while not all(empty):
-            tmp_run = []
-            for _ in range(r):
-                if not empty[0] and (empty[1] or a <= b):  # empty[1] = b is empty
-                    tmp_run.append(a)
-                    try:
-                        a = next(iter1)
-                    except StopIteration:
-                        os.remove(f'{bucket1[bucket1Index]}_{len(bucket1) // 2}')
-                        bucket1Index += 1
-                        if bucket1Index < len(bucket1):
-                            with open(f'{bucket1[bucket1Index]}_{len(bucket1) // 2}', 'rb') as f1:
-                                run1 = pickle.load(f1)
-                                iter1 = iter(run1)
-                            r = max(r, len(run1))
-                        else:
-                            empty[0] = True
-                            a = None
-                    continue
-                elif not empty[1] and (empty[0] or a > b):
-                    tmp_run.append(b)
-                    try:
-                        b = next(iter2)
-                    except StopIteration:
-                        os.remove(f'{bucket2[bucket2Index]}_{len(bucket1) // 2}')
-
-                        bucket2Index += 1
-                        if bucket2Index < len(bucket2):
-                            with open(f'{bucket2[bucket2Index]}_{len(bucket1) // 2}', 'rb') as f2:
-                                run2 = pickle.load(f2)
-                                iter2 = iter(run2)
-                            r = max(r, len(run2))
-                        else:
-                            empty[1] = True
-                            b = None
-                    continue
 
-                break
+def readahead(blocks: Iterator[Any], prefetch: int = PREFETCH) -> Iterator[Any]:
+    """
+    Load blocks in a background thread, at most `prefetch` blocks ahead of the consumer, so disk reads overlap with
+    the merge. Errors of the background thread are raised in the consumer.
 
-            fp = next(name_iter)
-            print(fp, (*bucket1, *bucket2), bucket1Index, bucket2Index)
-            with open(fp + '_' + str(len(bucket1)), 'wb') as f:
-                pickle.dump(tmp_run, f)
+    :param blocks: Iterator that loads the blocks, it is consumed by the background thread
+    :param prefetch: Number of blocks to load ahead, 0 loads every block when it's needed
+    """
+    if prefetch <= 0:
+        yield from blocks
+        return
 
-    while len(merged_files) > 1:
-        merged_files_tmp: list[tuple[str]] = []
-        for i in range(0, len(merged_files), 2):
-            if i + 1 == len(merged_files):
-                merged_files_tmp.append(merged_files[i])
+    buffer = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
                 continue
-            merge_pages(merged_files[i], merged_files[i + 1])
-            merged_files_tmp.append(merged_files[i] + merged_files[i + 1])
-        merged_files = merged_files_tmp
-
-    with open('result', 'w') as resf:
-        for file in merged_files[0]:
-            with open(file, 'rb') as f:
-                res = pickle.load(f)
-            resf.write('\n'.join(res))
-
-    # def phase0():
-    #     for page in allPages:
-    #         read(page)
-    #         run = sort(page)
-    #         store(run)  # where?
-    #         delete(page) ??
-
-    # def phaseX():
-    #
-    #     # Phase 2: Merge sorted pages
-    #     while len(pages) > 1:
-    #         new_pages = []
-    #         for i in range(0, len(pages), 2):
-    #             if i + 1 < len(pages):
-    #                 merged_page = merge_pages(pages[i], pages[i + 1])
-    #                 new_pages.append(merged_page)
-    #             else:
-    #                 new_pages.append(pages[i])
-    #         pages = new_pages
-    #
-    #     return pages[0].records if pages else []
-    #
-    # def merge_pages(page1, page2):
-    #     merged_records = []
-    #     heap = [(record, page) for page in [page1, page2] for record in page.records]
-    #     heapq.heapify(heap)
-    #
-    #     while heap:
-    #         record, _ = heapq.heappop(heap)
-    #         merged_records.append(record)
-    #
-    #     return Page(merged_records)
+        return False
+
+    def load():
+        try:
+            for block in blocks:
+                if not put((block, None)):
+                    return
+            put((_DONE, None))
+        except BaseException as e:
+            put((_DONE, e))
+
+    thread = threading.Thread(target=load, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block, error = buffer.get()
+            if block is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield block
+    finally:
+        # Consumer is done or stopped early, let the background thread finish
+        stop.set()
+        thread.join()
+
+
+class WriteBehind:
+    """
+    Write blocks in a background thread, so the merge can continue while the previous output blocks are written.
+    At most `buffers` blocks are waiting to be written, `put` blocks when the buffer is full.
+    """
+
+    def __init__(self, write: Callable[[Any], None], buffers: int = PREFETCH):
+        self.write = write
+        self.error = None
+        self.thread = None
+        if buffers > 0:
+            self.buffer = queue.Queue(maxsize=buffers)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while (block := self.buffer.get()) is not _DONE:
+            if self.error is None:
+                try:
+                    self.write(block)
+                except BaseException as e:
+                    # Keep consuming so the producer never blocks, the error is raised by put or close
+                    self.error = e
+
+    def put(self, block):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.write(block)
+        else:
+            self.buffer.put(block)
+
+    def close(self):
+        """
+        Wait until all blocks are written.
+        """
+        if self.thread is not None:
+            self.buffer.put(_DONE)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_run_file(file_path: str):
+    with open(file_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def dump_run_file(item: Tuple[str, Any]):
+    file_path, run = item
+    with open(file_path, 'wb') as f:
+        pickle.dump(run, f)
+
+
+def load_run_files(file_paths: Iterable[str]) -> Iterator[list]:
+    """
+    Load the run files of a bucket one by one, every file is removed once it's loaded.
+    """
+    for file_path in file_paths:
+        run = load_run_file(file_path)
+        os.remove(file_path)
+        yield run
+
+
+def two_way_external_merge_sort(pages: Iterable[Page], key: int, prefetch: int = PREFETCH) -> Iterator[bytearray]:
+    """
+    :param pages: Pages to sort, consumed one page at a time
+    :param key: Index used for comparison
+    :param prefetch: Number of runs loaded ahead per bucket and written behind during the merge
+    :return: Generator of the sorted records
+    """
+    with tempfile.TemporaryDirectory(prefix='merge_sort_') as tmp_dir:
+        file_names = itertools.count()
+
+        def new_file() -> str:
+            return os.path.join(tmp_dir, str(next(file_names)))
+
+        # Phase 0: Sort individual pages, every bucket is a sorted sequence of run files of at most one page
+        merged_files: List[List[str]] = []
+        run_length = 1
+        for page in pages:
+            run = [(entry[key], entry) for entry in page.sort(key)]
+            if run:
+                run_length = max(run_length, len(run))
+                merged_files.append([new_file()])
+                dump_run_file((merged_files[-1][0], run))
+
+        def merge_pages(bucket1: List[str], bucket2: List[str]) -> List[str]:
+            # The runs of both buckets are loaded ahead in the background while merging
+            runs1 = readahead(load_run_files(bucket1), prefetch)
+            runs2 = readahead(load_run_files(bucket2), prefetch)
+            merged = []
+            # Output runs are written behind while merging the next ones
+            with WriteBehind(dump_run_file, prefetch) as writer:
+                tmp_run = []
+                for entry in merge_runs((entry for run in runs1 for entry in run),
+                                        (entry for run in runs2 for entry in run), key=lambda entry: entry[0]):
+                    tmp_run.append(entry)
+                    # Output file is saved to disk once it's full
+                    if len(tmp_run) == run_length:
+                        merged.append(new_file())
+                        writer.put((merged[-1], tmp_run))
+                        tmp_run = []
+                if tmp_run:
+                    merged.append(new_file())
+                    writer.put((merged[-1], tmp_run))
+            return merged
+
+        # Phase X: Merge pairs of buckets until one sorted bucket is left
+        while len(merged_files) > 1:
+            merged_files_tmp: List[List[str]] = []
+            for i in range(0, len(merged_files), 2):
+                if i + 1 == len(merged_files):
+                    merged_files_tmp.append(merged_files[i])
+                    continue
+                merged_files_tmp.append(merge_pages(merged_files[i], merged_files[i + 1]))
+            merged_files = merged_files_tmp
+
+        for run in readahead(load_run_files(merged_files[0] if merged_files else []), prefetch):
+            for _, record in run:
+                yield record
+
+
+def write_run(file_path: str, entries: Iterable[Any], block_size: int = BLOCK_SIZE, prefetch: int = PREFETCH):
+    """
+    Write a sorted run to disk as a sequence of pickled blocks, so it can be read back one block at a time.
+    Blocks are written behind in a background thread while the next block is being filled.
+
+    :param file_path: Run file
+    :param entries: Sorted entries
+    :param block_size: Number of entries per block
+    :param prefetch: Number of blocks that can wait to be written
+    """
+    with open(file_path, 'wb') as f, WriteBehind(lambda block: pickle.dump(block, f), prefetch) as writer:
+        block = []
+        for entry in entries:
+            block.append(entry)
+            if len(block) == block_size:
+                writer.put(block)
+                block = []
+        if block:
+            writer.put(block)
+
+
+def read_blocks(file_path: str) -> Iterator[List[Any]]:
+    with open(file_path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def read_run(file_path: str, prefetch: int = PREFETCH) -> Iterator[Any]:
+    """
+    Stream the entries of a run file written by `write_run`, the next `prefetch` blocks are read ahead in a
+    background thread.
+
+    :param file_path: Run file
+    :param prefetch: Number of blocks to read ahead
+    :return: Generator of entries
+    """
+    for block in readahead(read_blocks(file_path), prefetch):
+        yield from block
+
+
+def merge_runs(run1: Iterator[Any], run2: Iterator[Any], key: Callable[[Any], Any]) -> Iterator[Any]:
+    """
+    Merge two sorted runs, comparing the first values of both runs and outputting the smallest one.
+    """
+    empty = object()
+    a, b = next(run1, empty), next(run2, empty)
+    while a is not empty and b is not empty:
+        if key(a) <= key(b):
+            yield a
+            a = next(run1, empty)
+        else:
+            yield b
+            b = next(run2, empty)
+    # One of the runs is exhausted, append the remaining values of the other run
+    if a is not empty:
+        yield a
+        yield from run1
+    if b is not empty:
+        yield b
+        yield from run2
+
+
+def external_sort(entries: Iterable[Any], key: Callable[[Any], Any], run_size: int = RUN_SIZE,
+                  prefetch: int = PREFETCH) -> Iterator[Any]:
+    """
+    2-way external merge sort of an arbitrary stream of entries, runs are stored in temporary files.
+
+    Phase 0: read `run_size` entries at a time, sort them in memory and store them as a run.
+    Phase X: merge pairs of runs until only one run is left, then stream it. Input blocks are read ahead and output
+    blocks are written behind in background threads, so reading and writing overlap with the comparisons.
+
+    :param entries: Entries to sort, can be larger than memory
+    :param key: Sort key
+    :param run_size: Number of entries sorted in memory in phase 0
+    :param prefetch: Number of blocks read ahead per input run and written behind for the output run
+    :return: Generator of sorted entries
+    """
+    with tempfile.TemporaryDirectory(prefix='sort_') as tmp_dir:
+        runs: List[str] = []
+
+        # Phase 0: sort chunks of entries
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) == run_size:
+                runs.append(os.path.join(tmp_dir, f'{len(runs)}_0'))
+                write_run(runs[-1], sorted(chunk, key=key), prefetch=prefetch)
+                chunk = []
+        if chunk or not runs:
+            runs.append(os.path.join(tmp_dir, f'{len(runs)}_0'))
+            write_run(runs[-1], sorted(chunk, key=key), prefetch=prefetch)
+
+        # Phase X: merge runs two by two
+        sort_pass = 0
+        while len(runs) > 1:
+            sort_pass += 1
+            merged_runs = []
+            for i in range(0, len(runs), 2):
+                if i + 1 == len(runs):
+                    merged_runs.append(runs[i])
+                    continue
+                merged = os.path.join(tmp_dir, f'{i}_{sort_pass}')
+                run1, run2 = read_run(runs[i], prefetch), read_run(runs[i + 1], prefetch)
+                write_run(merged, merge_runs(run1, run2, key), prefetch=prefetch)
+                os.remove(runs[i])
+                os.remove(runs[i + 1])
+                merged_runs.append(merged)
+            runs = merged_runs
+
+        yield from read_run(runs[0], prefetch)
@@ -0,0 +1,29 @@
+import random
+
+
+def generate_data(file_path: str, rows: int):
+    """
+    Generate a CSV file with fake users. Faker and pandas are only imported here, so they are never loaded by the
+    database itself.
+
+    :param file_path: CSV file
+    :param rows: Number of users
+    """
+    from faker import Faker
+    import pandas as pd
+
+    user_columns = ['id', 'name', 'email', 'phone', 'company', 'street', 'street_number', 'zipcode', 'country',
+                    'birthdate']
+    users = []
+    fake = Faker()
+    for i in range(rows):
+        user = [i, fake.name(), fake.ascii_email(), fake.basic_phone_number(), fake.company(), fake.street_name(),
+                random.randint(1, 1000), fake.zipcode(), fake.country(),
+                f'{random.randint(1970, 2005)}-{random.randint(1, 12)}-{random.randint(1, 28)}']
+        users.append(user)
+    df = pd.DataFrame(users, columns=user_columns)
+    df.to_csv(file_path, index=False)
+
+
+if __name__ == '__main__':
+    generate_data('fake_users.csv', 100000)
@@ -0,0 +1,141 @@
+import itertools
+import os
+from collections import deque
+from typing import List, Dict, Tuple, Callable, Optional, Iterator, Any
+
+import utils
+from aggregation import check_aggregates, new_states, update_states, merge_states, finalize_states
+from database import HeapFile, Page, PAGE_SIZE, load_page
+
+# Number of partitions per worker, more partitions than workers balances the load when pages are unevenly filled
+PARTITIONS_PER_WORKER = 4
+# Maximum number of pages in a partition, bounds the size of the result a worker sends back
+PARTITION_PAGES = 256
+# Number of partitions per worker that are submitted before their results are consumed
+IN_FLIGHT_PER_WORKER = 2
+# Maximum number of contiguous pages that are read from disk with one read
+READ_BATCH = 64
+
+
+def split_partitions(page_numbers: List[int], partitions: int) -> List[List[int]]:
+    """
+    Split the data pages in contiguous ranges of (almost) equal size, so every worker reads sequentially.
+    """
+    size, rest = divmod(len(page_numbers), partitions)
+    result, start = [], 0
+    for i in range(partitions):
+        end = start + size + (1 if i < rest else 0)
+        if end > start:
+            result.append(page_numbers[start:end])
+        start = end
+    return result
+
+
+def read_pages(db, page_numbers: List[int]) -> Iterator[Page]:
+    """
+    Read the given pages from an open file, runs of consecutive page numbers are read with a single read.
+    """
+    i = 0
+    while i < len(page_numbers):
+        j = i + 1
+        while j < len(page_numbers) and j - i < READ_BATCH and page_numbers[j] == page_numbers[j - 1] + 1:
+            j += 1
+        db.seek(page_numbers[i] * PAGE_SIZE)
+        data = db.read((j - i) * PAGE_SIZE)
+        for k in range(j - i):
+            yield load_page(bytearray(data[k * PAGE_SIZE:(k + 1) * PAGE_SIZE]))
+        i = j
+
+
+def scan_partition(file_path: str, page_numbers: List[int], schema: List[str]) -> Iterator[tuple]:
+    with open(file_path, 'rb') as db:
+        for page in read_pages(db, page_numbers):
+            for _, record in page.iter_records():
+                yield utils.decode_record(record, schema)
+
+
+def _filter_worker(file_path: str, page_numbers: List[int], schema: List[str], predicate: Optional[Callable],
+                   projection: Optional[List[int]]) -> List[tuple]:
+    result = []
+    for row in scan_partition(file_path, page_numbers, schema):
+        if predicate is None or predicate(row):
+            result.append(row if projection is None else tuple(row[column] for column in projection))
+    return result
+
+
+def _aggregate_worker(file_path: str, page_numbers: List[int], schema: List[str], predicate: Optional[Callable],
+                      group_by: List[int], aggs: List[Tuple[str, int]]) -> Dict[tuple, List[list]]:
+    table: Dict[tuple, List[list]] = {}
+    for row in scan_partition(file_path, page_numbers, schema):
+        if predicate is None or predicate(row):
+            key = tuple(row[column] for column in group_by)
+            if (states := table.get(key)) is None:
+                states = table[key] = new_states(aggs)
+            update_states(states, aggs, row)
+    return table
+
+
+def run_partitions(file_path: str, worker: Callable, args: tuple, processes: int = None) -> Iterator[Any]:
+    """
+    Split the data pages of the heap file in partitions and run `worker(file_path, page_numbers, *args)` for every
+    partition in a process pool. Every worker opens the file itself, read-only. Only a few partitions per worker are
+    submitted ahead of the consumer, so the results in memory don't grow with the size of the file.
+
+    :return: Generator of the results of the workers, in the order of the partitions
+    """
+    processes = processes or os.cpu_count() or 1
+    page_numbers = HeapFile(file_path).data_page_numbers()
+    num_partitions = max(processes * PARTITIONS_PER_WORKER, -(-len(page_numbers) // PARTITION_PAGES))
+    partitions = split_partitions(page_numbers, num_partitions)
+    if processes == 1 or len(partitions) <= 1:
+        for partition in partitions:
+            yield worker(file_path, partition, *args)
+        return
+    # multiprocessing is only loaded when a pool is needed
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        partitions = iter(partitions)
+        pending = deque(pool.submit(worker, file_path, partition, *args)
+                        for partition in itertools.islice(partitions, processes * IN_FLIGHT_PER_WORKER))
+        while pending:
+            result = pending.popleft().result()
+            if (partition := next(partitions, None)) is not None:
+                pending.append(pool.submit(worker, file_path, partition, *args))
+            yield result
+
+
+def parallel_scan(file_path: str, schema: List[str], predicate: Callable[[tuple], bool] = None,
+                  projection: List[int] = None, processes: int = None) -> Iterator[tuple]:
+    """
+    Full table scan with a filter and projection, spread over a pool of worker processes.
+    Only the data that is on disk is scanned, so commit before scanning. The predicate is sent to the workers, so it
+    has to be picklable (a module level function, not a lambda).
+
+    :param file_path: Heap file
+    :param schema: Schema of the records
+    :param predicate: Function on a decoded record, only records for which it returns True are kept
+    :param projection: Column indices to keep, all columns if None
+    :param processes: Number of worker processes, defaults to the number of cores
+    :return: Generator of the matching records, in the order they are stored
+    """
+    for result in run_partitions(file_path, _filter_worker, (schema, predicate, projection), processes):
+        yield from result
+
+
+def parallel_aggregate(file_path: str, schema: List[str], group_by: List[int], aggs: Dict[str, Tuple[str, int]],
+                       predicate: Callable[[tuple], bool] = None, processes: int = None) -> List[tuple]:
+    """
+    GROUP BY spread over a pool of worker processes, every worker computes partial aggregates for its partition
+    and these are merged in the parent.
+
+    :return: List of tuples (*group values, *aggregate values)
+    """
+    agg_list = check_aggregates(aggs)
+    table: Dict[tuple, List[list]] = {}
+    for result in run_partitions(file_path, _aggregate_worker, (schema, predicate, group_by, agg_list), processes):
+        for key, states in result.items():
+            if key in table:
+                merge_states(table[key], agg_list, states)
+            else:
+                table[key] = states
+    return [key + finalize_states(states, agg_list) for key, states in table.items()]
@@ -1,10 +1,26 @@
 import time
 import csv
 import os
+import subprocess
+import sys
 from typing import List
 from controller import Controller
+from database import HeapFile, FixedPage, PaxPage
 import utils
 
+COUNTRIES = ['Belgium', 'France', 'Germany', 'Spain', 'Italy', 'Guam', 'Bhutan']
+
+# Measured in a fresh interpreter: time to import the database and time to open the file and read one record by RID
+COLD_START_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from database import HeapFile, FixedPage, PaxPage
+imported = time.perf_counter()
+heap_file = HeapFile(sys.argv[1])
+heap_file.read_rid((int(sys.argv[2]), 0))
+print(imported - start, time.perf_counter() - imported)
+"""
+
 
 def cast_row_based_on_schema(row, schema):
     casted_row = []
@@ -63,6 +79,333 @@ def test_controller(filepath: str, csv_file: str, num_rows: int):
     print(f"Total completion time: {total_time} seconds")
 
 
+def generate_rows(num_rows: int, start: int = 0) -> List[tuple]:
+    """
+    Deterministic records in the user schema, so the tests don't depend on the csv file.
+    """
+    return [(i, f'Name {i}', f'user{i}@mail.com', f'{i:010d}', f'Company {i % 13}', f'Street {i % 97}', i % 1000,
+             1000 + i % 9000, COUNTRIES[i % len(COUNTRIES)], f'19{i % 100:02d}-1-{1 + i % 28}')
+            for i in range(start, start + num_rows)]
+
+
+def create_file(filepath: str, rows: List[tuple], schema: List[str], layout: str = None) -> Controller:
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    controller = Controller(filepath, schema, layout)
+    for row in rows:
+        controller.insert(row, schema)
+    controller.commit()
+    return Controller(filepath, schema, layout)
+
+
+def test_aggregation(filepath: str, num_rows: int):
+    from aggregation import hash_aggregate
+
+    rows = generate_rows(num_rows)
+    controller = create_file(filepath, rows, user_schema)
+    aggs = {'users': ('count', 0), 'street_nr': ('avg', 6), 'max_zip': ('max', 7), 'min_id': ('min', 0)}
+
+    expected = {}
+    for row in rows:
+        group = expected.setdefault(row[8], [0, 0, row[7], row[0]])
+        group[0] += 1
+        group[1] += row[6]
+        group[2] = max(group[2], row[7])
+        group[3] = min(group[3], row[0])
+    expected = sorted((country, count, total / count, max_zip, min_id)
+                      for country, (count, total, max_zip, min_id) in expected.items())
+
+    # memory_pages=0 spills every group to the partitions
+    for method in ('hash', 'sort'):
+        for memory_pages in (0, 1, 64):
+            result = sorted(controller.aggregate(user_schema, [8], aggs, memory_pages, method))
+            assert result == expected, f"Mismatch {method} with {memory_pages} pages: {result}"
+
+    # Groups that don't fit in a page are spilled to the overflow file
+    large_rows = [('a' * 5000 + str(i % 3), i) for i in range(30)]
+    result = sorted(hash_aggregate(large_rows, [0], {'n': ('count', 1)}, memory_pages=0))
+    assert [count for _, count in result] == [10, 10, 10], f"Mismatch with large groups: {result}"
+    print(f"Aggregation: {len(expected)} groups match for hash and sort, with and without spilling")
+
+
+def count_forwards(heap_file: HeapFile) -> int:
+    return sum(1 for page_nr in heap_file.data_page_numbers() for _ in heap_file.get_page(page_nr).forwards())
+
+
+def test_forward_pointers(filepath: str, num_rows: int, layout: str = None, short_values: bool = False):
+    schema = ['int', 'var_str', 'int']
+    # Values shorter than a RID take less space than the forward pointer that replaces them
+    rows = {i: (i, ('' if i % 2 else 'ab') if short_values else 'x' * 20, i) for i in range(num_rows)}
+    controller = create_file(filepath, list(rows.values()), schema, layout)
+    rids = {i: controller.heap_file.locate(utils.encode_record([i], ['int'])) for i in rows}
+
+    def check():
+        for i, row in rows.items():
+            assert controller.heap_file.locate(utils.encode_record([i], ['int'])) == rids[i], f"RID of {i} changed"
+            assert utils.decode_record(controller.heap_file.read_rid(rids[i]), schema) == row, f"Mismatch {i}"
+            assert utils.decode_record(controller.read(i), schema) == row, f"Mismatch {i}"
+        assert sorted(controller.scan(schema)) == sorted(rows.values()), "Mismatch scan"
+
+    # Grow every 5th record, the pages are full so they move and leave a forward pointer behind
+    for i in range(0, num_rows, 5):
+        rows[i] = (i, 'y' * 200, i)
+        controller.update(i, rows[i], schema)
+    assert count_forwards(controller.heap_file) > 0, "No records were moved"
+    check()
+
+    # Grow the moved records again, the forward pointer is updated so there is still only one hop
+    for i in range(0, num_rows, 5):
+        rows[i] = (i, 'z' * 250, i + num_rows)
+        controller.update(i, rows[i], schema)
+        forward = controller.heap_file.get_page(rids[i][0]).forward_rid(rids[i][1])
+        if forward is not None:
+            assert controller.heap_file.get_page(forward[0]).forward_rid(forward[1]) is None, f"Two hops for {i}"
+    check()
+    controller.commit()
+    controller = Controller(filepath, schema, layout)
+    check()
+
+    # Make room on the original pages, the moved records are moved back
+    for i in range(num_rows):
+        if i % 5 in (1, 2, 3):
+            controller.delete(i)
+            del rows[i]
+    forwards = count_forwards(controller.heap_file)
+    controller.heap_file.collapse_forwards()
+    assert count_forwards(controller.heap_file) < forwards, "No forward pointers were collapsed"
+    check()
+    controller.commit()
+    controller = Controller(filepath, schema, layout)
+    check()
+    name = (layout or 'slotted') + (', short values' if short_values else '')
+    print(f"Forward pointers ({name}): {forwards} collapsed to {count_forwards(controller.heap_file)}")
+
+
+def test_fixed_pages(filepath: str, num_rows: int):
+    schema = ['int', 'int', 'short', 'byte']
+    rows = {i: (i, i * 7, i % 60000, i % 256) for i in range(num_rows)}
+    controller = create_file(filepath, list(rows.values()), schema)
+    heap_file = controller.heap_file
+    page_numbers = heap_file.data_page_numbers()
+
+    def check():
+        for page_nr in controller.heap_file.data_page_numbers():
+            page = controller.heap_file.get_page(page_nr)
+            assert isinstance(page, FixedPage), f"Page {page_nr} isn't a fixed-length page"
+            # The number of used slots is counted from the bitmap
+            assert page.used == sum(1 for _ in page.iter_records()), f"Bitmap of page {page_nr} is wrong"
+        for i, row in rows.items():
+            assert utils.decode_record(controller.read(i), schema) == row, f"Mismatch {i}"
+        assert sorted(controller.scan(schema)) == sorted(rows.values()), "Mismatch scan"
+
+    check()
+    # Updates are in place
+    for i in range(0, num_rows, 3):
+        rid = heap_file.locate(utils.encode_record([i], ['int']))
+        rows[i] = (i, i * 11, i % 7, 1)
+        controller.update(i, rows[i], schema)
+        assert heap_file.locate(utils.encode_record([i], ['int'])) == rid, f"RID of {i} changed"
+    check()
+
+    # Deleted slots are reused by new records, the file doesn't grow
+    deleted = set()
+    for i in range(0, num_rows, 4):
+        deleted.add(heap_file.locate(utils.encode_record([i], ['int'])))
+        controller.delete(i)
+        del rows[i]
+    for i in range(num_rows, num_rows + len(deleted)):
+        rows[i] = (i, i, i % 60000, 2)
+        controller.insert(rows[i], schema)
+        assert heap_file.locate(utils.encode_record([i], ['int'])) in deleted, f"Slot of {i} wasn't reused"
+    assert heap_file.data_page_numbers() == page_numbers, "File grew"
+    check()
+    controller.commit()
+    # The layout is stored in the file, new pages are fixed-length pages without passing it again
+    controller = Controller(filepath)
+    for i in range(num_rows + len(deleted), num_rows * 2):
+        rows[i] = (i, i, i % 60000, 3)
+        controller.insert(rows[i], schema)
+    check()
+    controller.commit()
+    controller = Controller(filepath, schema)
+    check()
+    print(f"Fixed-length pages: {len(rows)} records in {len(controller.heap_file.data_page_numbers())} pages, "
+          f"{len(deleted)} slots reused")
+
+
+def benchmark_sort(filepath: str, num_rows: int):
+    from external_merge_sort import PREFETCH
+
+    controller = create_file(filepath, generate_rows(num_rows), user_schema)
+    records = list(controller.heap_file.scan())
+    for prefetch in (0, PREFETCH):
+        start_time = time.time()
+        result = list(controller.sort(key=0, prefetch=prefetch))
+        sort_time = time.time() - start_time
+        assert sorted(result) == sorted(records), f"Sort with prefetch {prefetch} lost records"
+        assert [record[0] for record in result] == sorted(record[0] for record in records), "Records aren't sorted"
+        assert sum(len(pd.pages) for pd in controller.heap_file.page_directories) == 0, "Sort kept pages in memory"
+        print(f"Sort of {num_rows} records with prefetch {prefetch}: {sort_time:.3f} seconds")
+
+
+def test_pax_pages(filepath: str, num_rows: int):
+    rows = {row[0]: row for row in generate_rows(num_rows)}
+    controller = create_file(filepath, list(rows.values()), user_schema, 'pax')
+    columns = [0, 6, 8]
+
+    def check():
+        page_numbers = controller.heap_file.data_page_numbers()
+        for page_nr in page_numbers:
+            assert isinstance(controller.heap_file.get_page(page_nr), PaxPage), f"Page {page_nr} isn't a PAX page"
+        for i, row in rows.items():
+            assert utils.decode_record(controller.read(i), user_schema) == row, f"Mismatch {i}"
+        assert sorted(controller.scan(user_schema)) == sorted(rows.values()), "Mismatch scan"
+        expected = sorted(tuple(row[column] for column in columns) for row in rows.values())
+        assert sorted(controller.scan_columns(user_schema, columns)) == expected, "Mismatch scan_columns"
+
+    check()
+    for i in range(0, num_rows, 3):
+        rows[i] = (i, f'Updated name {i}', '', '0', 'Company', f'Street {i}', i % 7, 1000, COUNTRIES[i % 3], '2000-1-1')
+        controller.update(i, rows[i], user_schema)
+    for i in range(1, num_rows, 5):
+        controller.delete(i)
+        del rows[i]
+    check()
+
+    # The layout and schema are stored in the file, new pages are PAX pages without passing them again
+    controller.commit()
+    controller = Controller(filepath)
+    for row in generate_rows(num_rows, num_rows):
+        rows[row[0]] = row
+        controller.insert(row, user_schema)
+    check()
+    controller.commit()
+    controller = Controller(filepath)
+    check()
+    try:
+        Controller(filepath, ['int', 'var_str'])
+        assert False, "Opening with another schema should fail"
+    except ValueError:
+        pass
+    print(f"PAX pages: {len(rows)} records in {len(controller.heap_file.data_page_numbers())} pages")
+
+
+def test_vacuum(filepath: str, num_rows: int):
+    schema = ['int', 'var_str']
+    rows = {i: (i, 'v' * 200) for i in range(num_rows)}
+    controller = create_file(filepath, list(rows.values()), schema)
+    heap_file = controller.heap_file
+    assert len(list(heap_file.iter_page_dirs())) > 1, "Use enough rows for several page directories"
+    rids = {utils.decode_record(record, schema)[0]: (page_nr, slot_id) for page_nr in heap_file.data_page_numbers()
+            for slot_id, record in heap_file.read_page(page_nr).iter_records()}
+
+    def check():
+        for i, row in rows.items():
+            assert utils.decode_record(controller.heap_file.read_rid(rids[i]), schema) == row, f"Mismatch RID {i}"
+        assert sorted(controller.scan(schema)) == sorted(rows.values()), "Mismatch scan"
+
+    # Delete the last third of the file and every row of some pages in the middle, grow some rows so they move
+    for i in range(num_rows):
+        if i >= num_rows * 2 // 3 or (i // 100) % 3 == 0:
+            controller.delete(i)
+            del rows[i]
+    for i in list(rows)[::50]:
+        rows[i] = (i, 'w' * 250)
+        controller.update(i, rows[i], schema)
+    controller.commit()
+    size = os.path.getsize(filepath)
+    last_page = max(rids.values())[0]
+
+    # A step visits one page, pages are only kept in memory when they change
+    controller = Controller(filepath, schema)
+    heap_file = controller.heap_file
+    heap_file.vacuum(max_steps=1)
+    assert sum(len(pd.pages) for pd in heap_file.page_directories) <= 2, "Vacuum kept unchanged pages in memory"
+    calls = 1
+    while not controller.vacuum(max_steps=10):
+        calls += 1
+    check()
+    assert os.path.getsize(filepath) < size, "File wasn't truncated"
+    assert len(list(heap_file.iter_page_dirs())) == 1, "Empty page directory wasn't dropped"
+    try:
+        heap_file.read_rid((last_page, 0))
+        assert False, "Reading a truncated page should fail"
+    except KeyError:
+        pass
+    controller.commit()
+    controller = Controller(filepath, schema)
+    check()
+
+    # Free pages are reused before the file grows
+    free_pages = set(controller.heap_file.page_directories[0].list_free_pages())
+    assert free_pages, "No pages were freed"
+    last_page = controller.heap_file.data_page_numbers()[-1]
+    for i in range(num_rows, num_rows + num_rows // 10):
+        rows[i] = (i, 'n' * 200)
+        controller.insert(rows[i], schema)
+    new_pages = set()
+    for page_nr in controller.heap_file.data_page_numbers():
+        for slot_id, record in controller.heap_file.read_page(page_nr).iter_records():
+            if (i := utils.decode_record(record, schema)[0]) >= num_rows:
+                rids[i] = page_nr, slot_id
+                new_pages.add(page_nr)
+    assert new_pages & free_pages, "Free pages weren't reused"
+    assert controller.heap_file.data_page_numbers()[-1] == last_page, "File grew while pages were free"
+    check()
+
+    # Relocating records gives them a new RID, they are found by id
+    controller.vacuum(relocate=True)
+    for i, row in rows.items():
+        assert utils.decode_record(controller.read(i), schema) == row, f"Mismatch {i}"
+    assert sorted(controller.scan(schema)) == sorted(rows.values()), "Mismatch scan"
+    controller.commit()
+    print(f"Vacuum: {calls} calls, file from {size} to {os.path.getsize(filepath)} bytes")
+
+
+def is_born_in_eighties(row: tuple) -> bool:
+    # Module level, so it can be sent to the worker processes
+    return row[9].startswith('198')
+
+
+def test_parallel_scan(filepath: str, num_rows: int):
+    rows = generate_rows(num_rows)
+    controller = create_file(filepath, rows, user_schema)
+    expected = [(row[0], row[8]) for row in rows if is_born_in_eighties(row)]
+    aggs = {'users': ('count', 0), 'max_zip': ('max', 7)}
+    expected_groups = sorted(controller.aggregate(user_schema, [8], aggs))
+
+    for num_processes in (1, 2, 4):
+        start_time = time.time()
+        result = list(controller.parallel_scan(user_schema, is_born_in_eighties, [0, 8], num_processes))
+        scan_time = time.time() - start_time
+        assert result == expected, f"Mismatch with {num_processes} processes"
+        groups = sorted(controller.parallel_aggregate(user_schema, [8], aggs, processes=num_processes))
+        assert groups == expected_groups, f"Mismatch aggregate with {num_processes} processes: {groups}"
+        print(f"Parallel scan with {num_processes} processes: {num_rows / scan_time:.0f} rows per second")
+    print(f"Parallel scan: results match the serial scan ({os.cpu_count()} cores)")
+
+
+def benchmark_cold_start(filepath: str, repeat: int = 5):
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    last_page = HeapFile(filepath).data_page_numbers()[-1]
+
+    def run(*args) -> (float, str):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, *args], cwd=package_dir, check=True, capture_output=True, text=True)
+        return time.perf_counter() - start, output.stdout
+
+    interpreter = min(run('-c', 'pass')[0] for _ in range(repeat))
+    import_controller = min(run('-c', 'import controller')[0] for _ in range(repeat)) - interpreter
+    timings = [run('-c', COLD_START_SCRIPT, os.path.abspath(filepath), str(last_page))[1].split() for _ in
+               range(repeat)]
+    import_database = min(float(imported) for imported, _ in timings)
+    open_and_read = min(float(opened) for _, opened in timings)
+
+    print(f"Import controller: {import_controller * 1000:.1f} ms")
+    print(f"Import database: {import_database * 1000:.1f} ms")
+    print(f"Open and point read (page {last_page}): {open_and_read * 1000:.1f} ms")
+
+
 if __name__ == "__main__":
     user_schema = ['int', 'var_str', 'var_str', 'var_str', 'var_str', 'var_str', 'int', 'int', 'var_str', 'var_str']
     num_rows = 100
@@ -70,3 +413,14 @@ if __name__ == "__main__":
     csv_file = "fake_users.csv"
 
     test_controller(filepath, csv_file, num_rows)
+    test_forward_pointers("forward.bin", 1000)
+    test_forward_pointers("forward.bin", 1000, 'pax')
+    test_forward_pointers("forward.bin", 1000, short_values=True)
+    test_forward_pointers("forward.bin", 1000, 'pax', short_values=True)
+    test_fixed_pages("fixed.bin", 3000)
+    test_pax_pages("pax.bin", 2000)
+    test_vacuum("vacuum.bin", 9000)
+    test_aggregation("aggregation.bin", 3000)
+    benchmark_sort("sort.bin", 3000)
+    test_parallel_scan("parallel.bin", 20000)
+    benchmark_cold_start(filepath)
@@ -1,10 +1,19 @@
 import struct
-from faker import Faker
-import pandas as pd
-import random
-import csv
 
-from typing import List
+from typing import List, Optional
+
+
+# Size in bytes of the fixed-width field types
+FIELD_SIZES = {'int': 4, 'short': 2, 'byte': 1}
+
+
+def fixed_record_size(schema: List[str]) -> Optional[int]:
+    """
+    :return: Size of an encoded record if all fields have a fixed width, None if the schema contains a var_str
+    """
+    if any(field_type not in FIELD_SIZES for field_type in schema):
+        return None
+    return sum(FIELD_SIZES[field_type] for field_type in schema)
 
 
 def encode_var_string(s: str):
@@ -55,30 +64,3 @@ def decode_record(byte_array, schema: List[str]):
         value, start_idx = decode_field(byte_array, start_idx, field_type)
         decoded_fields.append(value)
     return tuple(decoded_fields)
-
-
-def generate_data(file_path: str, rows: int):
-    user_columns = ['id', 'name', 'email', 'phone', 'company', 'street', 'street_number', 'zipcode', 'country',
-                    'birthdate']
-    users = []
-    fake = Faker()
-    for i in range(rows):
-        user = [i, fake.name(), fake.ascii_email(), fake.basic_phone_number(), fake.company(), fake.street_name(),
-                random.randint(1, 1000), fake.zipcode(), fake.country(),
-                f'{random.randint(1970, 2005)}-{random.randint(1, 12)}-{random.randint(1, 28)}']
-        users.append(user)
-    df = pd.DataFrame(users, columns=user_columns)
-    df.to_csv(file_path, index=False)
-
-
-if __name__ == '__main__':
-    # schema = ['int', 'var_str', 'short', 'int', 'int', 'byte', 'var_str', 'var_str', 'var_str', 'var_str']
-    #
-    # record = (1, "Alice", 23, 12345, 987654, 4, "alice@email.com", "1234567890", "ACME", "Elm St")
-    #
-    # encoded = encode_record(record, schema)
-    # print(len(encoded))
-    # print(encoded)
-    # decoded = decode_record(encoded, schema)
-    # print(decoded)
-    generate_data('fake_users.csv', 100000)